@@ -0,0 +1,261 @@
+'''
+Benchmarks for SpikeDetekt on synthetic data. Run from anywhere with:
+
+    python dev/benchmark.py [name ...]
+
+where the names are any of the benchmarks listed in BENCHMARKS (all of them
+if none is given). Each benchmark prints a small table of its results.
+'''
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+from spikedetekt.parameters import Parameters
+
+
+def best_of(f, repeat=3):
+    '''
+    Returns the pair (result, time) of the fastest of repeat calls of f().
+    '''
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        result = f()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return result, best
+
+
+def linear_graph(n_ch):
+    '''
+    Channel graph of a linear probe with nearest and next nearest neighbours.
+    '''
+    return dict((i, set(j for j in (i - 2, i - 1, i + 1, i + 2)
+                        if 0 <= j < n_ch))
+                for i in xrange(n_ch))
+
+
+def synthetic_filtered(n_s, n_ch, rate, seed=0):
+    '''
+    Unit variance noise with negative spikes on 4 neighbouring channels, rate
+    is the number of spikes per 1000 samples. Returns (FilteredChunk,
+    Threshold, ChannelGraph) with a 4.5 SD threshold.
+    '''
+    rng = np.random.RandomState(seed)
+    X = rng.randn(n_s, n_ch).astype(np.float32)
+    t = np.arange(-8, 9)
+    shape = -10 * np.exp(-t ** 2 / 6.)
+    for s in rng.randint(10, n_s - 10, size=int(rate * n_s / 1000.)):
+        c = rng.randint(0, n_ch - 4)
+        for k in xrange(4):
+            X[s + t, c + k] += shape * (1 - .2 * k)
+    return X, 4.5 * np.ones(n_ch), linear_graph(n_ch)
+
+
+def bench_coarse_detection():
+    '''
+    Speed and recall of USE_COARSE_DETECTION against full resolution
+    thresholding and flood filling. A component counts as recalled if the
+    coarse path finds exactly the same set of (sample, channel) points.
+    '''
+    from spikedetekt.detection import detect_window, coarse_components
+    Parameters['DETECT_POSITIVE'] = False
+    Parameters['REJECT_ARTIFACTS'] = False
+    s_join = 10
+    print '%8s %8s %6s %10s %10s %8s %8s' % (
+        'channels', 'rate', 'decim', 'full (s)', 'coarse (s)', 'speedup',
+        'recall')
+    for n_ch in (32, 128):
+        for rate in (.5, 2., 10.):
+            X, Threshold, G = synthetic_filtered(20000, n_ch, rate)
+
+            def full():
+                return detect_window(X, X, Threshold, G, s_join)[0]
+            comps_full, t_full = best_of(full)
+            comps_full = set(frozenset(c) for c in comps_full)
+            for decimation in (8, 32):
+                Parameters['COARSE_DECIMATION'] = decimation
+
+                def coarse():
+                    return coarse_components(X, X, Threshold, G, s_join)[0]
+                comps_coarse, t_coarse = best_of(coarse)
+                comps_coarse = set(frozenset(c) for c in comps_coarse)
+                recall = (len(comps_full & comps_coarse) /
+                          float(max(len(comps_full), 1)))
+                print '%8d %8.1f %6d %10.4f %10.4f %8.2f %8.4f' % (
+                    n_ch, rate, decimation, t_full, t_coarse,
+                    t_full / t_coarse, recall)
+
+
+def synthetic_waves(n_spikes, n_s, n_ch, seed=0):
+    '''
+    Waves of shape (n_spikes, n_s, n_ch): smooth random spike shapes of random
+    amplitudes plus unit variance noise.
+    '''
+    rng = np.random.RandomState(seed)
+    t = np.linspace(-3, 3, n_s)
+    templates = np.array([-np.exp(-(t - rng.randn() * .3) ** 2 /
+                                  (.5 + rng.rand())) for _ in xrange(5)])
+    which = rng.randint(0, len(templates), size=(n_spikes, n_ch))
+    amplitudes = 10 * rng.rand(n_spikes, 1, n_ch)
+    X = templates[which].transpose(0, 2, 1) * amplitudes
+    return (X + rng.randn(n_spikes, n_s, n_ch)).astype(np.float32)
+
+
+def bench_pca_solver():
+    '''
+    Speed and accuracy of PCA_SOLVER 'randomized' against 'full'. The
+    accuracy is the smallest fraction, over channels, of the variance
+    explained by the exact top FPC components that the randomized ones
+    explain.
+    '''
+    from spikedetekt.features import CovarianceAccumulator
+    FPC = Parameters['FPC']
+    print '%8s %8s %10s %10s %8s %10s' % (
+        'channels', 'samples', 'full (s)', 'rand (s)', 'speedup', 'accuracy')
+    for n_ch in (32, 256):
+        for n_s in (20, 60, 120):
+            acc = CovarianceAccumulator(n_s, n_ch)
+            acc.add(synthetic_waves(2000, n_s, n_ch))
+            Cov_css = acc.covariances()
+            timings = {}
+            PCs = {}
+            for solver in ('full', 'randomized'):
+                Parameters['PCA_SOLVER'] = solver
+                PCs[solver], timings[solver] = best_of(lambda: acc.pcs(FPC))
+
+            def explained(PC_3s):
+                U_csf = PC_3s.transpose(2, 1, 0).astype(np.float64)
+                return np.einsum('csf,cst,ctf->c', U_csf, Cov_css, U_csf)
+            accuracy = (explained(PCs['randomized']) /
+                        explained(PCs['full'])).min()
+            print '%8d %8d %10.4f %10.4f %8.2f %10.6f' % (
+                n_ch, n_s, timings['full'], timings['randomized'],
+                timings['full'] / timings['randomized'], accuracy)
+    Parameters['PCA_SOLVER'] = 'full'
+
+
+def bench_compression():
+    '''
+    Write time and file size of the waveforms table, for S_TOTAL samples per
+    spike on the channels of a shank, stored as float32 or as int16
+    (INT16_WAVES), with each of the HDF5_COMPLIB, HDF5_COMPLEVEL and
+    HDF5_SHUFFLE settings available here. The synthetic waves are rounded to
+    integers, as the raw data and the quantized waves are.
+    '''
+    import tempfile
+    import tables
+    from spikedetekt.files import (waveform_description, table_sizes,
+                                   table_filters, BufferedTableWriter)
+    n_spikes = 10000
+    settings = [('zlib', 0, False), ('zlib', 1, False), ('zlib', 1, True),
+                ('zlib', 5, True), ('lzo', 1, True), ('blosc', 1, True),
+                ('blosc', 5, True)]
+    print '%8s %8s %6s %6s %6s %8s %10s %10s %8s' % (
+        'channels', 'S_TOTAL', 'dtype', 'lib', 'level', 'shuffle',
+        'write (s)', 'size (MB)', 'ratio')
+    directory = tempfile.mkdtemp()
+    filename = os.path.join(directory, 'waves.h5')
+    for n_ch in (8, 32):
+        for s_total in (20, 40):
+            for int16 in (False, True):
+                Parameters['S_TOTAL'] = s_total
+                Parameters['INT16_WAVES'] = int16
+                description = waveform_description(n_ch)
+                # in the stored dtype of each column
+                rows = np.zeros(n_spikes, dtype=[
+                    (name, col.dtype)
+                    for name, col in description.columns.iteritems()])
+                rows['wave'] = np.round(10 * synthetic_waves(
+                    n_spikes, s_total, n_ch))
+                rows['unfiltered_wave'] = np.round(100 * synthetic_waves(
+                    n_spikes, s_total, n_ch, seed=1))
+                raw_size = None
+                for complib, complevel, shuffle in settings:
+                    if tables.whichLibVersion(complib) is None:
+                        continue
+                    Parameters['HDF5_COMPLIB'] = complib
+                    Parameters['HDF5_COMPLEVEL'] = complevel
+                    Parameters['HDF5_SHUFFLE'] = shuffle
+
+                    def write():
+                        h5 = tables.openFile(filename, 'w')
+                        t = h5.createTable(
+                            '/', 'waveforms', description,
+                            filters=table_filters(),
+                            **table_sizes(description, n_spikes))
+                        writer = BufferedTableWriter(t)
+                        for start in xrange(0, n_spikes, 500):
+                            writer.append(rows[start:start + 500])
+                        writer.flush()
+                        h5.close()
+                    _, elapsed = best_of(write)
+                    size = os.path.getsize(filename)
+                    if raw_size is None:
+                        raw_size = size
+                    print '%8d %8d %6s %6s %6d %8s %10.4f %10.2f %8.2f' % (
+                        n_ch, s_total, rows.dtype['wave'].base, complib,
+                        complevel, shuffle, elapsed, size / 1e6,
+                        raw_size / float(size))
+    os.remove(filename)
+    os.rmdir(directory)
+    Parameters['HDF5_COMPLEVEL'] = 0
+    Parameters['INT16_WAVES'] = False
+
+
+def bench_text_writers():
+    '''
+    Speed of write_text against np.savetxt for arrays shaped like the .fet,
+    .fmask and .res files, and whether the outputs are identical.
+    '''
+    from cStringIO import StringIO
+    from spikedetekt.files import write_text
+    rng = np.random.RandomState(0)
+    n_spikes = 100000
+    arrays = [
+        ('.fet', (rng.randn(n_spikes, 97) * 30000).astype(np.int32), '%i'),
+        ('.fmask', rng.rand(n_spikes, 97).astype(np.float32), '%f'),
+        # exact ties at the 7th decimal, negative zero and large values
+        ('floats', np.hstack((rng.randint(-1000, 1000, (n_spikes, 3)) / 128.,
+                              -rng.rand(n_spikes, 1) * 1e-8,
+                              rng.randn(n_spikes, 2) * 1e7)), '%f'),
+        ('.res', np.cumsum(rng.randint(1, 100, n_spikes)), '%i'),
+    ]
+    print '%8s %10s %12s %10s %8s %10s' % (
+        'file', 'shape', 'savetxt (s)', 'fast (s)', 'speedup', 'identical')
+    for name, X, fmt in arrays:
+        def savetxt():
+            f = StringIO()
+            np.savetxt(f, X, fmt=fmt)
+            return f.getvalue()
+
+        def fast():
+            f = StringIO()
+            write_text(f, X, fmt=fmt)
+            return f.getvalue()
+        text_savetxt, t_savetxt = best_of(savetxt, repeat=1)
+        text_fast, t_fast = best_of(fast, repeat=1)
+        print '%8s %10s %12.3f %10.3f %8.2f %10s' % (
+            name, 'x'.join(map(str, X.shape)), t_savetxt, t_fast,
+            t_savetxt / t_fast, text_savetxt == text_fast)
+
+
+BENCHMARKS = [
+    ('coarse_detection', bench_coarse_detection),
+    ('pca_solver', bench_pca_solver),
+    ('compression', bench_compression),
+    ('text_writers', bench_text_writers),
+]
+
+if __name__ == '__main__':
+    names = sys.argv[1:]
+    for name, f in BENCHMARKS:
+        if not names or name in names:
+            print name
+            print '=' * len(name)
+            f()
+            print
@@ -0,0 +1,119 @@
+'''
+Check of the 64-bit sample times on a recording longer than 2**31 samples,
+made of two sparse .dat files which take almost no disk space. Run from
+anywhere with:
+
+    python dev/test_long_recording.py
+
+A spike is written after sample 2**31 of the concatenated recording, found
+again by reading the chunks of the .dat files and filtering the one it is
+in, and written to the spikedetekt table of a .main.h5 file and the .res and
+.fet files. The times and dat file offsets are checked to be exact.
+'''
+import os
+import sys
+import shutil
+import tempfile
+import numpy as np
+import tables
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+from spikedetekt.parameters import Parameters
+from spikedetekt.core import set_globals_samples, write_metadata
+from spikedetekt.files import (num_samples, chunks, shank_description,
+                               waveform_description, write_klusters_file,
+                               read_res)
+from spikedetekt.filtering import apply_filtering, get_filter_params
+
+N_CH = 2
+# samples of the two .dat files, the spike is in the second one
+N_SAMPLES = [2 ** 31 - 5000, 30000]
+SPIKE_TIME = 2 ** 31 + 1000
+
+
+class Probe(object):
+    probes = {1: [(0, 1)]}
+
+
+def write_dat_files(directory):
+    '''
+    Writes the sparse .dat files, zero but for a negative spike on both
+    channels at SPIKE_TIME, and returns their names.
+    '''
+    names = [os.path.join(directory, name) for name in ('a.dat', 'b.dat')]
+    for name, n in zip(names, N_SAMPLES):
+        with open(name, 'wb') as f:
+            f.truncate(n * N_CH * 2)
+    t = np.arange(-8, 9)
+    spike = (-1000 * np.exp(-t ** 2 / 6.)).astype(np.int16)
+    with open(names[1], 'r+b') as f:
+        f.seek((SPIKE_TIME - 8 - N_SAMPLES[0]) * N_CH * 2)
+        np.repeat(spike, N_CH).tofile(f)
+    return names
+
+
+def find_spike(DatFileNames):
+    '''
+    Returns the sample of the minimum of the filtered data of the chunk
+    holding the spike, reading all the chunks as detection does.
+    '''
+    filter_params = get_filter_params()
+    for DatChunk, s_start, s_end, keep_start, keep_end in chunks(
+            DatFileNames, N_CH, range(N_CH)):
+        if keep_start <= SPIKE_TIME < keep_end:
+            FilteredChunk = apply_filtering(filter_params, DatChunk)
+            time = s_start + FilteredChunk[:, 0].argmin()
+    return time
+
+
+def main():
+    set_globals_samples(20000, Parameters['F_HIGH_FACTOR'])
+    Parameters['CHUNK_OVERLAP'] = int(
+        Parameters['SAMPLE_RATE'] * Parameters['CHUNK_OVERLAP_SECONDS'])
+    Parameters['N_CH'] = N_CH
+    directory = tempfile.mkdtemp()
+    try:
+        DatFileNames = write_dat_files(directory)
+        assert num_samples(DatFileNames, N_CH) == sum(N_SAMPLES)
+        time = find_spike(DatFileNames)
+        assert time == SPIKE_TIME, time
+
+        basename = os.path.join(directory, 'long')
+        h5 = tables.openFile(basename + '.main.h5', 'w')
+        write_metadata(h5, Probe(), DatFileNames, N_CH)
+        offsets = h5.root.metadata.datfiles_offsets_samples[:]
+        assert offsets.dtype == np.int64
+        assert list(offsets) == [0, N_SAMPLES[0]], offsets
+        sd_table = h5.createTable('/', 'spikedetekt', shank_description(N_CH))
+        wave_table = h5.createTable('/', 'waveforms',
+                                    waveform_description(N_CH))
+        rows = np.zeros(1, dtype=sd_table.dtype)
+        rows['time'] = time
+        rows['mask_binary'] = 1
+        # the time as last feature, as written by core
+        rows['features'][:, -1] = time
+        sd_table.append(rows)
+        wave_table.append(np.zeros(1, dtype=wave_table.dtype))
+        assert sd_table.cols.time.dtype == np.int64
+        assert sd_table.cols.time[0] == SPIKE_TIME
+        shank_table = {('spikedetekt', 1): sd_table,
+                       ('waveforms', 1): wave_table}
+        for export in ['res', 'fet']:
+            write_klusters_file(export, shank_table, 1, basename)
+        h5.close()
+
+        assert list(read_res(basename + '.res.1').ravel()) == [SPIKE_TIME]
+        with open(basename + '.res.1') as f:
+            assert f.read() == '%d\n' % SPIKE_TIME
+        with open(basename + '.fet.1') as f:
+            lines = f.read().splitlines()
+        assert lines[0] == str(1 + Parameters['FPC'] * N_CH)
+        assert int(lines[1].split()[-1]) == SPIKE_TIME, lines[1]
+        print 'spike at sample %d of %d: ok' % (time, sum(N_SAMPLES))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
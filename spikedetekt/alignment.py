@@ -83,6 +83,28 @@ def extract_wave(IndList, FilteredArr, s_before,
     return Wave, PeakSample, ChMask
 
 
+def extract_peak(IndList, FilteredArr):
+    '''
+    Cheap peak pick for a connected component, without upsampling or
+    alignment.
+
+    Returns a tuple (PeakSample, PeakChannel, PeakAmplitude, NumChannels),
+    where PeakSample and PeakChannel are the sample and channel of the most
+    extreme value of FilteredArr over the points in IndList, PeakAmplitude is
+    that value and NumChannels the number of distinct channels in IndList.
+    '''
+    IndArr = np.array(IndList, dtype=np.int32)
+    SampArr = IndArr[:, 0]
+    ChArr = IndArr[:, 1]
+    Values = FilteredArr[SampArr, ChArr]
+    if Parameters['DETECT_POSITIVE']:
+        PeakInd = np.abs(Values).argmax()
+    else:
+        PeakInd = Values.argmin()
+    return (SampArr[PeakInd], ChArr[PeakInd], Values[PeakInd],
+            len(np.unique(ChArr)))
+
+
 def abc(x_3, y_3):
     M = np.vstack((x_3 ** 2, x_3, np.ones_like(x_3)))
     return np.linalg.solve(M.T, y_3)
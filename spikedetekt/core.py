@@ -10,20 +10,24 @@ import tables
 import json
 import os
 import h5py
-from itertools import izip
 
 import probes
 from files import write_fet
-from graphs import contig_segs, complete_if_none, add_penumbra
+from graphs import contig_segs, add_penumbra
 from utils import indir, basename_noext, get_padded, switch_ext
-from floodfill import connected_components
-from features import compute_pcs, reget_features, project_features
-from files import (num_samples, klusters_files,
-                   get_chunk_for_thresholding, chunks, shank_description,
-                   waveform_description, FilWriter)
-from filtering import apply_filtering, get_filter_params
+from features import (reget_features, project_features_block, PCTrainer,
+                      SinglePassFeatures)
+from files import (num_samples, klusters_files, klusters_files_parallel,
+                   shank_description, waveform_description,
+                   detection_description, artifact_description,
+                   write_artifacts, BufferedTableWriter, table_sizes,
+                   expected_spikes, table_filters, quantize_waves,
+                   SparseWaveTable, SparseFeatureTable, KlustersStream,
+                   description_dtype, write_klusters_xml, npy_files,
+                   SpikeIndex, spike_amplitudes, LiveWriter)
 from progressbar import ProgressReporter
-from alignment import extract_wave
+from alignment import extract_wave, extract_peak
+from detection import ChunkDetector
 from os.path import join, abspath, dirname
 from parameters import Parameters, GlobalVariables
 from time import sleep
@@ -31,8 +35,6 @@ from subsets import cluster_withsubsets
 from masking import get_float_mask
 from log import log_message, log_warning
 #from IPython import embed
-import debug
-from debug import plot_diagnostics  # for debugging with Parameters['DEBUG']
 
 
 def set_globals_samples(sample_rate, high_frequency_factor):
@@ -48,6 +50,9 @@ def set_globals_samples(sample_rate, high_frequency_factor):
     exec 'S_AFTER = int(T_AFTER*SAMPLE_RATE)' in Parameters
     exec 'S_TOTAL = S_BEFORE + S_AFTER' in Parameters
     exec 'S_JOIN_CC = T_JOIN_CC*SAMPLE_RATE' in Parameters
+    exec 'S_ARTIFACT_PADDING = int(T_ARTIFACT_PADDING*SAMPLE_RATE)' in Parameters
+    exec ('S_MAX_COMPONENT = None if T_MAX_COMPONENT is None '
+          'else int(T_MAX_COMPONENT*SAMPLE_RATE)') in Parameters
 
 ####################################
 ######## High-level scripts ########
@@ -92,9 +97,14 @@ def spike_detection_job(DatFileNames, ProbeFileName, output_dir, output_name):
         # Print Parameters dictionary to .log file
         log_message("\n".join(["{0:s} = {1:s}".format(key, str(value))
                     for key, value in sorted(Parameters.iteritems()) if not key.startswith('_')]))
-        spike_detection_from_raw_data(basename, DatFileNames, n_ch_dat,
-                                      Channels_dat, probe.channel_graph,
-                                      probe, max_spikes)
+        if Parameters['DETECT_ONLY']:
+            spike_detection_only(basename, DatFileNames, n_ch_dat,
+                                 Channels_dat, probe.channel_graph,
+                                 probe, max_spikes)
+        else:
+            spike_detection_from_raw_data(basename, DatFileNames, n_ch_dat,
+                                          Channels_dat, probe.channel_graph,
+                                          probe, max_spikes)
 
         numwarn = GlobalVariables['warnings']
         if numwarn:
@@ -108,6 +118,125 @@ def spike_detection_job(DatFileNames, ProbeFileName, output_dir, output_name):
     #log_message("\n".join(["{0:s} = {1:s}".format(key, str(value)) for key, value in Parameters.iteritems()]))
 
 
+def write_metadata(h5, probe, DatFileNames, n_ch_dat):
+    """
+    Write the parameters, the probe and the dat file offsets to the metadata
+    group of an HDF5 file.
+    """
+    n_samples = np.array([num_samples(DatFileName, n_ch_dat)
+                         for DatFileName in DatFileNames], dtype=np.int64)
+    metadata_group = h5.createGroup('/', 'metadata')
+    parameters_group = h5.createGroup(metadata_group, 'parameters')
+    for k, v in Parameters.items():
+        if not k.startswith('_'):
+            if isinstance(v, bool):
+                r = int(v)
+            elif isinstance(v, (int, float)):
+                r = v
+            else:
+                r = repr(v)
+            h5.setNodeAttr(parameters_group, k, r)
+    h5.setNodeAttr(metadata_group, 'probe', json.dumps(probe.probes))
+    h5.createArray(metadata_group, 'datfiles_offsets_samples',
+                   np.hstack((0, np.cumsum(n_samples)))[:-1])
+
+
+def spike_detection_only(
+        basename, DatFileNames, n_ch_dat, Channels_dat,
+        ChannelGraph, probe, max_spikes):
+    """
+    Filter and detect from raw data, without extracting waves or features.
+
+    For each spike, only the time, peak channel, peak amplitude and number of
+    channels of its connected component are written, to the table
+    /shanks/shank_N/detections of the .main.h5 file, which is always kept.
+    """
+    n_samples = num_samples(DatFileNames, n_ch_dat)
+    main_h5 = tables.openFile(basename + '.main.h5', 'w')
+    shanks_group = main_h5.createGroup('/', 'shanks')
+    shank_table = {}
+    shank_group = {}
+    spike_index = {}
+    description = detection_description()
+    for i in probe.shanks_set:
+        shank_group[i] = main_h5.createGroup(shanks_group, 'shank_' + str(i))
+        shank_table[i] = BufferedTableWriter(main_h5.createTable(
+            shank_group[i], 'detections', description,
+            **table_sizes(description, expected_spikes(n_samples))))
+        spike_index[i] = SpikeIndex(len(probe.channel_set[i]))
+    channel_list = dict((shank, np.array(sorted(probe.channel_set[shank])))
+                        for shank in probe.shanks_set)
+    write_metadata(main_h5, probe, DatFileNames, n_ch_dat)
+
+    progress_bar = ProgressReporter()
+    detector = ChunkDetector(DatFileNames, n_ch_dat, Channels_dat,
+                             ChannelGraph)
+    spike_count = 0
+    for (DatChunk, FilteredChunk, IndListsChunk,
+         s_start, s_end, keep_start, keep_end) in detector:
+        peaks = [extract_peak(IndList, FilteredChunk)
+                 for IndList in IndListsChunk]
+        peaks = [(s_start + s_peak, Channels_dat[c_peak], amplitude, n_ch)
+                 for s_peak, c_peak, amplitude, n_ch in peaks
+                 if keep_start <= s_start + s_peak < keep_end and
+                 Channels_dat[c_peak] in probe.channel_to_shank]
+        peaks.sort()
+        spike_count += len(peaks)
+        for shank in probe.shanks_set:
+            t = shank_table[shank]
+            rows = [peak for peak in peaks
+                    if probe.channel_to_shank[peak[1]] == shank]
+            if rows:
+                rows = np.array(rows, dtype=t.table.dtype)
+                t.append(rows)
+                # the spikes are counted on their peak channel
+                channels = channel_list[shank]
+                masks = (rows['peak_channel'][:, np.newaxis] ==
+                         channels[np.newaxis, :])
+                spike_index[shank].add(rows['time'], masks,
+                                       np.abs(rows['peak_amplitude']))
+        progress_bar.update(float(s_end) / n_samples,
+                            '%d/%d samples, %d spikes found' % (s_end, n_samples, spike_count))
+        if max_spikes is not None and spike_count >= max_spikes:
+            break
+    progress_bar.finish()
+    for t in shank_table.values():
+        t.flush()
+    for shank in probe.shanks_set:
+        spike_index[shank].write(main_h5, shank_group[shank])
+
+    if Parameters['REJECT_ARTIFACTS']:
+        record_artifacts(main_h5, basename, detector.rejected_intervals)
+    log_split_components(detector)
+    main_h5.close()
+
+
+def log_split_components(detector):
+    """
+    Log how many extra components splitting oversized ones created, and how
+    many were left oversized.
+    """
+    if Parameters['S_MAX_COMPONENT'] is not None:
+        log_message('%d extra components created by splitting oversized '
+                    'connected components' % detector.n_splits)
+        log_message('%d oversized connected components left whole, without '
+                    'a minimum of their crossing profile to split at' %
+                    detector.n_unsplit)
+
+
+def record_artifacts(h5, basename, intervals):
+    """
+    Write the intervals rejected as artifacts to the /artifacts table of an
+    HDF5 file and to the .artifacts file.
+    """
+    t = h5.createTable('/', 'artifacts', artifact_description())
+    if intervals:
+        t.append(np.array(intervals, dtype=t.dtype))
+    write_artifacts(intervals, basename + '.artifacts')
+    log_message('%d intervals (%d samples) rejected as artifacts' % (
+        len(intervals), sum(end - start for start, end in intervals)))
+
+
 def spike_detection_from_raw_data(
         basename, DatFileNames, n_ch_dat, Channels_dat,
         ChannelGraph, probe, max_spikes):
@@ -120,10 +249,11 @@ def spike_detection_from_raw_data(
 
     np.savetxt("dat_channels.txt", Channels_dat, fmt="%i")
 
-    # Create HDF5 files
+    # Create HDF5 files, without the waves when streaming the Klusters files
+    stream = Parameters['STREAM_KLUSTERS']
     h5s = {}
     h5s_filenames = {}
-    for n in ['main', 'waves']:
+    for n in ['main'] if stream else ['main', 'waves']:
         filename = basename + '.' + n + '.h5'
         h5s[n] = tables.openFile(filename, 'w')
         h5s_filenames[n] = filename
@@ -133,210 +263,389 @@ def spike_detection_from_raw_data(
             h5s[n] = tables.openFile(filename, 'w')
             h5s_filenames[n] = filename
     main_h5 = h5s['main']
+    # the tables are sized for the spikes expected in the whole recording
+    n_spikes = expected_spikes(num_samples(DatFileNames, n_ch_dat))
     # Shanks groups
     shanks_group = {}
     shank_group = {}
-    shank_table = {}
     for k in ['main', 'waves']:
+        if k not in h5s:
+            continue
         h5 = h5s[k]
         shanks_group[k] = h5.createGroup('/', 'shanks')
         for i in probe.shanks_set:
             shank_group[k, i] = h5.createGroup(
                 shanks_group[k], 'shank_' + str(i))
-    # waveform data for wave file
-    for i in probe.shanks_set:
-        shank_table['waveforms', i] = h5s['waves'].createTable(
-            shank_group['waves', i], 'waveforms',
+    # spikes go to the tables of each shank, through buffers appending them
+    # in large blocks, or to the Klusters files written during detection
+    klusters_stream = {}
+    if stream:
+        shank_table = {}
+        for i in probe.shanks_set:
+            klusters_stream[i] = KlustersStream(basename, i,
+                                                len(probe.channel_set[i]))
+    else:
+        shank_table = create_shank_tables(h5s, shank_group, probe, n_spikes)
+    # coarse index of the spikes of each shank, in the .main.h5 file
+    spike_index = dict((i, SpikeIndex(len(probe.channel_set[i])))
+                       for i in probe.shanks_set)
+    table_writer = dict((key, BufferedTableWriter(t))
+                        for key, t in shank_table.iteritems())
+    # the dtypes of the rows of spikes of each shank
+    row_dtype = dict((key, t.dtype) for key, t in shank_table.iteritems())
+    for i in klusters_stream:
+        row_dtype['spikedetekt', i] = description_dtype(
+            shank_description(len(probe.channel_set[i])))
+        row_dtype['waveforms', i] = description_dtype(
             waveform_description(len(probe.channel_set[i])))
-    # spikedetekt data for main file, and links to waveforms
-    for i in probe.shanks_set:
-        shank_table[
-            'spikedetekt', i] = main_h5.createTable(shank_group['main', i],
-                                                    'spikedetekt', shank_description(len(probe.channel_set[i])))
-        main_h5.createExternalLink(shank_group['main', i], 'waveforms',
-                                   shank_table['waveforms', i])
     # Metadata
-    n_samples = np.array([num_samples(DatFileName, n_ch_dat)
-                         for DatFileName in DatFileNames])
-    for k, h5 in h5s.items():
-        metadata_group = h5.createGroup('/', 'metadata')
-        parameters_group = h5.createGroup(metadata_group, 'parameters')
-        for k, v in Parameters.items():
-            if not k.startswith('_'):
-                if isinstance(v, bool):
-                    r = int(v)
-                elif isinstance(v, (int, float)):
-                    r = v
-                else:
-                    r = repr(v)
-                h5.setNodeAttr(parameters_group, k, r)
-        h5.setNodeAttr(metadata_group, 'probe', json.dumps(probe.probes))
-        h5.createArray(metadata_group, 'datfiles_offsets_samples',
-                       np.hstack((0, np.cumsum(n_samples)))[:-1])
+    for h5 in h5s.values():
+        write_metadata(h5, probe, DatFileNames, n_ch_dat)
+    # spikes that can be read during detection, in the .live.h5 file
+    live = None
+    if Parameters['LIVE_HDF5']:
+        if h5py.version.hdf5_version_tuple < (1, 10):
+            log_warning('The .live.h5 file needs h5py with HDF5 1.10 or '
+                        'later for SWMR, not %s' % h5py.version.hdf5_version)
+        else:
+            h5s_filenames['live'] = basename + '.live.h5'
+            live = LiveWriter(h5s_filenames['live'], probe,
+                              num_samples(DatFileNames, n_ch_dat), row_dtype)
+
+    # shank number of each channel, -1 for channels not on any shank
+    channel_shank = -np.ones(Parameters['N_CH'], dtype=np.int32)
+    for channel, shank in probe.channel_to_shank.iteritems():
+        channel_shank[channel] = shank
+    channel_list = dict((shank, np.array(sorted(list(probe.channel_set[shank]))))
+                        for shank in probe.shanks_set)
+    # principal components trained during detection, unless they are computed
+    # afterwards from the first waves in the table
+    pc_trainer = {}
+    # or features computed during detection
+    single_pass = {}
+    if Parameters['PCA_SINGLE_PASS'] and not stream:
+        for shank in probe.shanks_set:
+            single_pass[shank] = SinglePassFeatures(Parameters['S_TOTAL'],
+                                                    len(channel_list[shank]),
+                                                    Parameters['PCA_MAXWAVES'])
+    elif Parameters['PCA_TRAINING'] != 'first':
+        for shank in probe.shanks_set:
+            pc_trainer[shank] = PCTrainer(Parameters['S_TOTAL'],
+                                          len(channel_list[shank]),
+                                          Parameters['PCA_TRAINING'],
+                                          Parameters['PCA_MAXWAVES'])
 
     ########## MAIN TIME CONSUMING LOOP OF PROGRAM ########################
-    for (USpk, Spk, PeakSample,
-         ChannelMask, FloatChannelMask) in extract_spikes(h5s, basename,
-                                                          DatFileNames,
-                                                          n_ch_dat,
-                                                          Channels_dat,
-                                                          ChannelGraph,
-                                                          max_spikes,
-                                                          ):
-        # what shank are we in?
-        nzc, = ChannelMask.nonzero()
-        internzc = list(set(nzc).intersection(probe.channel_to_shank.keys()))
-        if internzc:
-            shank = probe.channel_to_shank[internzc[0]]
-        else:
+    detector = ChunkDetector(DatFileNames, n_ch_dat, Channels_dat,
+                             ChannelGraph)
+    samples_done = 0
+    for batch in extract_spike_batches(h5s, basename, DatFileNames, n_ch_dat,
+                                       Channels_dat, ChannelGraph, max_spikes,
+                                       detector=detector):
+        samples_done = batch.keep_end
+        if not len(batch):
+            if live is not None:
+                live.flush(samples_done)
             continue
-        # write only the channels of this shank
-        channel_list = np.array(sorted(list(probe.channel_set[shank])))
-        t = shank_table['spikedetekt', shank]
-        t.row['time'] = PeakSample
-        t.row['mask_binary'] = ChannelMask[channel_list]
-        t.row['mask_float'] = FloatChannelMask[channel_list]
-        t.row.append()
-        # and the waveforms
-        t = shank_table['waveforms', shank]
-        t.row['wave'] = Spk[:, channel_list]
-        t.row['unfiltered_wave'] = USpk[:, channel_list]
-        t.row.append()
-
+        # what shank are we in? the first unmasked channel which belongs to
+        # a shank decides, spikes with no such channel are dropped
+        onshank = batch.masks & (channel_shank >= 0)
+        spike_shank = channel_shank[onshank.argmax(axis=1)]
+        spike_shank[~onshank.any(axis=1)] = -1
+        for shank in probe.shanks_set:
+            spikes, = (spike_shank == shank).nonzero()
+            if not len(spikes):
+                continue
+            # write only the channels of this shank
+            channels = channel_list[shank]
+            sd_rows = np.zeros(len(spikes),
+                               dtype=row_dtype['spikedetekt', shank])
+            sd_rows['time'] = batch.times[spikes]
+            sd_rows['mask_binary'] = batch.masks[np.ix_(spikes, channels)]
+            sd_rows['mask_float'] = batch.float_masks[np.ix_(spikes, channels)]
+            # and the waveforms
+            wave_rows = np.zeros(len(spikes),
+                                 dtype=row_dtype['waveforms', shank])
+            if Parameters['INT16_WAVES']:
+                wave_rows['wave'] = quantize_waves(
+                    batch.waves[spikes][:, :, channels])
+            else:
+                wave_rows['wave'] = batch.waves[spikes][:, :, channels]
+            wave_rows['unfiltered_wave'] = batch.unfiltered_waves[spikes][:, :, channels]
+            if Parameters['SPARSE_WAVES'] and not stream:
+                # only the masked channels are stored, the others read as
+                # zeros, so they are zero for the features too
+                wave_rows['channel_mask'] = sd_rows['mask_binary']
+                mask = sd_rows['mask_binary'][:, np.newaxis, :]
+                wave_rows['wave'] *= mask
+                wave_rows['unfiltered_wave'] *= mask
+            spike_index[shank].add(sd_rows['time'], sd_rows['mask_binary'],
+                                   spike_amplitudes(wave_rows['wave'],
+                                                    sd_rows['mask_binary']))
+            if live is not None:
+                live.append(shank, sd_rows, wave_rows)
+            if stream:
+                klusters_stream[shank].append(sd_rows, wave_rows)
+                if pc_trainer:
+                    pc_trainer[shank].add(wave_rows['wave'])
+                continue
+            if single_pass:
+                for (sd_rows, wave_rows), f in single_pass[shank].add(
+                        wave_rows['wave'], (sd_rows, wave_rows)):
+                    append_with_features(table_writer, shank, sd_rows,
+                                         wave_rows, f)
+                continue
+            table_writer['spikedetekt', shank].append(sd_rows)
+            table_writer['waveforms', shank].append(wave_rows)
+            if pc_trainer:
+                pc_trainer[shank].add(wave_rows['wave'])
+        if live is not None:
+            live.flush(samples_done)
+    if live is not None:
+        live.close(samples_done)
+
+    if Parameters['REJECT_ARTIFACTS']:
+        record_artifacts(main_h5, basename, detector.rejected_intervals)
+    log_split_components(detector)
+
+    for t in table_writer.values():
+        t.flush()
+    for shank in probe.shanks_set:
+        spike_index[shank].write(main_h5, shank_group['main', shank])
     for h5 in h5s.values():
         h5.flush()
 
     # Feature extraction
     for shank in probe.shanks_set:
-        X = shank_table[
-            'waveforms',
-            shank].cols.wave[
-            :Parameters[
-                'PCA_MAXWAVES']]
-        PC_3s = reget_features(X)
-        # embed()
-        for sd_row, w_row in izip(shank_table['spikedetekt', shank],
-                                  shank_table['waveforms', shank]):
-            f = project_features(PC_3s, w_row['wave'])
-            # f needs to have shape (n_ch, PCs)
-            # embed()
-            # NEW
-            # add PCA components
-            sd_row['PC_3s'] = PC_3s.flatten()
-
-            sd_row['features'] = np.hstack((f.flatten(), sd_row['time']))
-            # embed()
-            sd_row.update()
+        if stream:
+            klusters_stream[shank].close()
+            if pc_trainer:
+                PC_3s = pc_trainer[shank].pcs()
+            else:
+                PC_3s = reget_features(
+                    klusters_stream[shank].waves()[:Parameters['PCA_MAXWAVES']])
+            klusters_stream[shank].finish(PC_3s)
+        elif single_pass:
+            sp = single_pass[shank]
+            for (sd_rows, wave_rows), f in sp.finish():
+                append_with_features(table_writer, shank, sd_rows, wave_rows,
+                                     f)
+            table_writer['spikedetekt', shank].flush()
+            table_writer['waveforms', shank].flush()
+            PC_3s = sp.PC_3s
+            if PC_3s is None:
+                # no spikes on this shank, its PC_3s node is still written
+                PC_3s = np.zeros((Parameters['FPC'], Parameters['S_TOTAL'],
+                                  len(channel_list[shank])))
+            else:
+                drift = sp.drift()
+                log_message('Shank %s: drift of the principal components %f'
+                            % (shank, drift))
+                if drift > Parameters['PCA_DRIFT_TOLERANCE']:
+                    log_message('Recomputing the features of shank %s with '
+                                'the principal components of all spikes' %
+                                shank)
+                    PC_3s = sp.final_pcs()
+                    write_features(shank_table['spikedetekt', shank],
+                                   shank_table['waveforms', shank], PC_3s)
+        else:
+            if pc_trainer:
+                PC_3s = pc_trainer[shank].pcs()
+            else:
+                X = shank_table[
+                    'waveforms',
+                    shank].cols.wave[
+                    :Parameters[
+                        'PCA_MAXWAVES']]
+                PC_3s = reget_features(X)
+            write_features(shank_table['spikedetekt', shank],
+                           shank_table['waveforms', shank], PC_3s)
+        # the principal components, of shape (FPC, S_TOTAL, shanksize), are
+        # stored once per shank
+        main_h5.createArray(shank_group['main', shank], 'PC_3s',
+                            PC_3s.astype(np.float32))
 
     main_h5.flush()
 
-    klusters_files(h5s, shank_table, basename, probe)
-
-    for key, h5 in h5s.iteritems():
-        h5.close()
+    if Parameters['WRITE_NPY_FILES']:
+        if stream:
+            log_warning('The NPY files are not written with STREAM_KLUSTERS')
+        else:
+            npy_files(main_h5, shank_table, basename, probe)
+
+    if stream:
+        write_klusters_xml(probe, basename)
+        for h5 in h5s.values():
+            h5.close()
+    elif Parameters['EXPORT_WORKERS'] > 1:
+        # the worker processes open the HDF5 files themselves, read-only
+        for h5 in h5s.values():
+            h5.close()
+        klusters_files_parallel(h5s_filenames, basename, probe,
+                                Parameters['EXPORT_WORKERS'])
+    else:
+        klusters_files(h5s, shank_table, basename, probe)
+        for h5 in h5s.values():
+            h5.close()
+
+    for key in h5s_filenames:
         if not Parameters['KEEP_OLD_HDF5_FILES']:
             # NEW: erase the HDF5 files at the end, because we're using a direct
             # conversion tool in KlustaViewa for now.
             os.remove(h5s_filenames[key])
 
 
+def create_shank_tables(h5s, shank_group, probe, n_spikes):
+    """
+    Create the spikedetekt and waveforms tables of each shank, sized for
+    n_spikes spikes, and return them in a dictionary with keys
+    ('spikedetekt', shank) and ('waveforms', shank).
+    """
+    main_h5 = h5s['main']
+    filters = table_filters()
+    shank_table = {}
+    # waveform data for wave file
+    for i in probe.shanks_set:
+        description = waveform_description(len(probe.channel_set[i]))
+        if Parameters['SPARSE_WAVES']:
+            shank_table['waveforms', i] = SparseWaveTable.create(
+                h5s['waves'], shank_group['waves', i], 'waveforms',
+                len(probe.channel_set[i]), filters=filters,
+                expectedrows=n_spikes)
+        else:
+            shank_table['waveforms', i] = h5s['waves'].createTable(
+                shank_group['waves', i], 'waveforms', description,
+                filters=filters, **table_sizes(description, n_spikes))
+        if Parameters['INT16_WAVES']:
+            # filtered waves are quantized to the units of the raw data, as
+            # in the .spk files, so that these are straight copies
+            shank_table['waveforms', i].attrs.wave_scale = 1.
+            shank_table['waveforms', i].attrs.wave_offset = 0.
+    # spikedetekt data for main file, and links to waveforms
+    for i in probe.shanks_set:
+        description = shank_description(len(probe.channel_set[i]))
+        if Parameters['SPARSE_FEATURES']:
+            shank_table['spikedetekt', i] = SparseFeatureTable.create(
+                main_h5, shank_group['main', i], 'spikedetekt', description,
+                filters=filters, expectedrows=n_spikes)
+        else:
+            shank_table[
+                'spikedetekt', i] = main_h5.createTable(shank_group['main', i],
+                                                        'spikedetekt', description,
+                                                        filters=filters,
+                                                        **table_sizes(description, n_spikes))
+        main_h5.createExternalLink(shank_group['main', i], 'waveforms',
+                                   h5s['waves'].getNode(shank_group['waves', i],
+                                                        'waveforms'))
+    return shank_table
+
+
+def append_with_features(table_writer, shank, sd_rows, wave_rows, features):
+    """
+    Append spikes to the tables of a shank, through the table writers, with
+    their features already computed.
+    """
+    sd_rows['features'][:, :-1] = features
+    sd_rows['features'][:, -1] = sd_rows['time']
+    table_writer['spikedetekt', shank].append(sd_rows)
+    table_writer['waveforms', shank].append(wave_rows)
+
+
+def write_features(sd_table, wave_table, PC_3s, blocksize=4096):
+    """
+    Project the waves of wave_table on the principal components PC_3s, and
+    write the features (with the time as last feature) to the rows of
+    sd_table, blocksize rows at a time.
+    """
+    for start in xrange(0, len(sd_table), blocksize):
+        X = wave_table.cols.wave[start:start + blocksize]
+        stop = start + len(X)
+        f = project_features_block(PC_3s, X)
+        time = sd_table.cols.time[start:stop]
+        sd_table.modifyColumn(start, stop,
+                              column=np.hstack((f, time[:, np.newaxis])),
+                              colname='features')
+
+
 ###########################################################
 ############# Spike extraction helper functions ###########
 ###########################################################
-# m
-# m this function returns for each detected spike a triplet Spk,PeakSample,ST
-# m Spk is an array of shape no. of samples (to record for each spike) x no. of channels, e.g., 28X16
-# m PeakSample is the position of the peak (e.g. 435688)
-# m ST (to the best of my understanding) is a bool array (no. of channels long) which shows on which
-# m                                      channels the threshold was crossed (?)
+
+
+class SpikeBatch(object):
+
+    '''
+    The spikes found in one chunk, in time sorted order, as contiguous arrays:
+
+    times
+        Peak sample of each spike, shape (n_spikes,)
+    waves
+        Aligned filtered waves, shape (n_spikes, S_TOTAL, N_CH)
+    unfiltered_waves
+        Raw data around the peak, shape (n_spikes, S_TOTAL, N_CH)
+    masks
+        Binary channel masks (with penumbra), shape (n_spikes, N_CH)
+    float_masks
+        Float channel masks, shape (n_spikes, N_CH)
+    keep_end
+        End of the samples of the chunk, all spikes before it have been found
+    '''
+
+    def __init__(self, times, waves, unfiltered_waves, masks, float_masks,
+                 keep_end=None):
+        self.times = times
+        self.waves = waves
+        self.unfiltered_waves = unfiltered_waves
+        self.masks = masks
+        self.float_masks = float_masks
+        self.keep_end = keep_end
+
+    def __len__(self):
+        return len(self.times)
+
+
 def extract_spikes(h5s, basename, DatFileNames, n_ch_dat,
                    ChannelsToUse, ChannelGraph,
                    max_spikes=None):
+    '''
+    Yields a tuple (uwave, wave, s, cm, fcm) for each detected spike, see
+    extract_spike_batches for the meaning of each element.
+    '''
+    for batch in extract_spike_batches(h5s, basename, DatFileNames, n_ch_dat,
+                                       ChannelsToUse, ChannelGraph,
+                                       max_spikes):
+        for i in xrange(len(batch)):
+            yield (batch.unfiltered_waves[i], batch.waves[i], batch.times[i],
+                   batch.masks[i], batch.float_masks[i])
+
+
+def extract_spike_batches(h5s, basename, DatFileNames, n_ch_dat,
+                          ChannelsToUse, ChannelGraph,
+                          max_spikes=None, detector=None):
+    '''
+    Yields a SpikeBatch for each chunk of the data. The chunks come from
+    detector, a new ChunkDetector if it is None.
+    '''
     # some global variables we use
-    CHUNK_SIZE = Parameters['CHUNK_SIZE']
-    CHUNKS_FOR_THRESH = Parameters['CHUNKS_FOR_THRESH']
-    DTYPE = Parameters['DTYPE']
-    CHUNK_OVERLAP = Parameters['CHUNK_OVERLAP']
     N_CH = Parameters['N_CH']
-    S_JOIN_CC = Parameters['S_JOIN_CC']
     S_BEFORE = Parameters['S_BEFORE']
     S_AFTER = Parameters['S_AFTER']
-    THRESH_SD = Parameters['THRESH_SD']
-
-    # filter coefficents for the high pass filtering
-    filter_params = get_filter_params()
+    S_TOTAL = Parameters['S_TOTAL']
 
     progress_bar = ProgressReporter()
 
-    # m A code that writes out a high-pass filtered version of the raw data
-    # (.fil file)
-    fil_writer = FilWriter(DatFileNames, n_ch_dat)
-
-    # Just use first dat file for getting the thresholding data
-    with open(DatFileNames[0], 'rb') as fd:
-        # Use 5 chunks to figure out threshold
-        DatChunk = get_chunk_for_thresholding(fd, n_ch_dat, ChannelsToUse,
-                                              num_samples(DatFileNames[0],
-                                                          n_ch_dat))
-        FilteredChunk = apply_filtering(filter_params, DatChunk)
-        # .6745 converts median to standard deviation
-        if Parameters['USE_SINGLE_THRESHOLD']:
-            ThresholdSDFactor = np.median(np.abs(FilteredChunk)) / .6745
-        else:
-            ThresholdSDFactor = np.median(
-                np.abs(FilteredChunk),
-                axis=0) / .6745
-        Threshold = ThresholdSDFactor * THRESH_SD
-
-        print 'Threshold = ', Threshold, '\n'
-        # Record the absolute Threshold used
-        Parameters['THRESHOLD'] = Threshold
+    if detector is None:
+        detector = ChunkDetector(DatFileNames, n_ch_dat, ChannelsToUse,
+                                 ChannelGraph)
+    Threshold = detector.Threshold
+    ThresholdSDFactor = detector.ThresholdSDFactor
+    ChannelGraphToUse = detector.ChannelGraph
 
     n_samples = num_samples(DatFileNames, n_ch_dat)
 
     spike_count = 0
-    for (DatChunk, s_start, s_end,
-         keep_start, keep_end) in chunks(DatFileNames, n_ch_dat, ChannelsToUse):
-        ############## FILTERING ########################################
-        FilteredChunk = apply_filtering(filter_params, DatChunk)
-
-        # write filtered output to file
-        # if Parameters['WRITE_FIL_FILE']:
-        fil_writer.write(FilteredChunk, s_start, s_end, keep_start, keep_end)
-
-        ############## THRESHOLDING #####################################
-        if Parameters['DETECT_POSITIVE']:
-            BinaryChunk = np.abs(FilteredChunk) > Threshold
-        else:
-            BinaryChunk = (FilteredChunk < -Threshold)
-        BinaryChunk = BinaryChunk.astype(np.int8)
-        # write binary chunk filtered output to file
-        if Parameters['WRITE_BINFIL_FILE']:
-            fil_writer.write_bin(
-                BinaryChunk,
-                s_start,
-                s_end,
-                keep_start,
-                keep_end)
-        ############### FLOOD FILL  ######################################
-        ChannelGraphToUse = complete_if_none(ChannelGraph, N_CH)
-        IndListsChunk = connected_components(BinaryChunk,
-                                             ChannelGraphToUse, S_JOIN_CC)
-        if Parameters['DEBUG']:
-            plot_diagnostics(
-                s_start,
-                IndListsChunk,
-                BinaryChunk,
-                DatChunk,
-                FilteredChunk,
-                Threshold)
-            fil_writer.write_bin(
-                BinaryChunk,
-                s_start,
-                s_end,
-                keep_start,
-                keep_end)
-
+    for (DatChunk, FilteredChunk, IndListsChunk,
+         s_start, s_end, keep_start, keep_end) in detector:
         ############## ALIGN AND INTERPOLATE WAVES #######################
         nextbits = []
         for IndList in IndListsChunk:
@@ -354,14 +663,25 @@ def extract_spikes(h5s, basename, DatFileNames, n_ch_dat,
                 log_warning(s)
         # and return them in time sorted order
         nextbits.sort(key=lambda wave_s_cm: wave_s_cm[1])
-        for wave, s, cm in nextbits:
+        n_spikes = len(nextbits)
+        times = np.zeros(n_spikes, dtype=np.int64)
+        waves = np.zeros((n_spikes, S_TOTAL, N_CH), dtype=np.float32)
+        uwaves = np.zeros((n_spikes, S_TOTAL, N_CH), dtype=np.int32)
+        masks = np.zeros((n_spikes, N_CH), dtype=np.bool8)
+        fmasks = np.zeros((n_spikes, N_CH), dtype=np.float32)
+        for i, (wave, s, cm) in enumerate(nextbits):
             uwave = get_padded(DatChunk, int(s) - S_BEFORE - s_start,
                                int(s) + S_AFTER - s_start).astype(np.int32)
             cm = add_penumbra(cm, ChannelGraphToUse,
                               Parameters['PENUMBRA_SIZE'])
             fcm = get_float_mask(wave, cm, ChannelGraphToUse,
                                  ThresholdSDFactor)
-            yield uwave, wave, s, cm, fcm
+            times[i] = s
+            waves[i] = wave
+            uwaves[i] = uwave
+            masks[i] = cm
+            fmasks[i] = fcm
+        yield SpikeBatch(times, waves, uwaves, masks, fmasks, keep_end)
         progress_bar.update(float(s_end) / n_samples,
                             '%d/%d samples, %d spikes found' % (s_end, n_samples, spike_count))
         if max_spikes is not None and spike_count >= max_spikes:
@@ -46,8 +46,32 @@ T_AFTER = .0005  # time after peak in extracted spike
 # maximum time between two samples for them to be "contiguous" in
 # detection step
 T_JOIN_CC = .0005
+# coarse to fine detection: only threshold and flood fill at full resolution
+# around blocks of COARSE_DECIMATION samples whose minimum crosses threshold,
+# faster for sparse firing
+USE_COARSE_DETECTION = False
+COARSE_DECIMATION = 16
+# artifact rejection: blank the threshold crossings, before flood filling,
+# of samples where at least ARTIFACT_CHANNEL_FRACTION of the channels cross
+# threshold at once, or where the raw data reaches ARTIFACT_SATURATION in
+# absolute value on any channel (None to disable, e.g. 32767 for int16),
+# padded by T_ARTIFACT_PADDING seconds. Rejected intervals are written to the
+# .artifacts file and the .main.h5 file
+REJECT_ARTIFACTS = False
+ARTIFACT_CHANNEL_FRACTION = 0.5
+ARTIFACT_SATURATION = None
+T_ARTIFACT_PADDING = .002
+# bound on the duration of connected components, those lasting longer than
+# T_MAX_COMPONENT seconds are split at the local minima of their number of
+# crossing channels over time, and left whole if there are none (None for
+# no bound)
+T_MAX_COMPONENT = None
 # mask penumbra size (0 no penumbra, 1 first neighbours, etc.)
 PENUMBRA_SIZE = 0
+# only detect spikes: skip alignment, masks, features and the Klusters files,
+# and write the time, peak channel, peak amplitude and number of channels of
+# each spike to /shanks/shank_N/detections in the .main.h5 file (always kept)
+DETECT_ONLY = False
 
 # Options for alignment
 USE_WEIGHTED_MEAN_PEAK_SAMPLE = True  # used for aligning waves
@@ -56,6 +80,22 @@ UPSAMPLING_FACTOR = 10  # used for aligning waves
 # Options for features
 FPC = 3  # Features per channel
 PCA_MAXWAVES = 10000  # number of waves to use to extract principal components
+# how the waves for the principal components are chosen: 'first' for the
+# first PCA_MAXWAVES waves of each shank, 'reservoir' for a uniform random
+# sample of PCA_MAXWAVES waves of the whole recording, 'all' for every wave
+# (covariances accumulated during detection, memory does not grow)
+PCA_TRAINING = 'first'
+# compute the features during detection, in a single pass over the waves,
+# with principal components trained on the first PCA_MAXWAVES waves of each
+# shank (PCA_TRAINING is then ignored). The features are recomputed at the
+# end with the principal components of all waves if the relative loss of
+# explained variance on some channel is above PCA_DRIFT_TOLERANCE
+PCA_SINGLE_PASS = False
+PCA_DRIFT_TOLERANCE = 0.05
+# eigensolver for the principal components: 'full' (eigh of the covariance
+# matrices) or 'randomized' (only the top FPC components, faster for long
+# spike windows, see dev/benchmark.py pca_solver for the accuracy)
+PCA_SOLVER = 'full'
 SHOW_PCS = False  # show principal components
 
 # Options for masking
@@ -71,6 +111,66 @@ CHUNK_SIZE = 20000
 # overlap time (in seconds) of chunks, should be wider than spike width
 CHUNK_OVERLAP_SECONDS = 0.01
 
+# Expected number of spikes per second on each shank, used to size the HDF5
+# tables (expectedrows and chunkshape)
+EXPECTED_SPIKE_RATE = 100.
+
+# Compression of the spikedetekt and waveforms tables: HDF5_COMPLIB is one of
+# 'zlib', 'lzo', 'bzip2' or 'blosc', HDF5_COMPLEVEL from 0 (no compression) to
+# 9, and HDF5_SHUFFLE applies the byte shuffle filter before compressing. See
+# dev/benchmark.py compression for the trade-off between write time and size
+HDF5_COMPLIB = 'zlib'
+HDF5_COMPLEVEL = 0
+HDF5_SHUFFLE = False
+
+# store the waves in the .waves.h5 file as int16 instead of float32, the
+# filtered waves quantized as in the .spk files (scale and offset in the
+# wave_scale and wave_offset attributes of the waveforms tables)
+INT16_WAVES = False
+
+# store in the .waves.h5 file only the waves on the channels of the channel
+# mask of each spike (with penumbra), the other channels are zero when read
+# back and in the .spk/.uspk files, for shanks with many channels
+SPARSE_WAVES = False
+
+# store in the .main.h5 file only the features and masks of the channels
+# where the binary or float mask is nonzero, the features of the other
+# channels are zero when read back and in the .fet files
+SPARSE_FEATURES = False
+
+# write the .res, .spk, .uspk, .mask and .fmask files during detection, and
+# the .fet and .clu files at the end from the .spk file, instead of going
+# through the spike tables of the HDF5 files (which are then not written,
+# nor the .waves.h5 file). The features are computed from the quantized
+# waves of the .spk file, and PCA_SINGLE_PASS is not used
+STREAM_KLUSTERS = False
+
+# number of worker processes writing the Klusters files of the shanks, 1 to
+# write them in the main process
+EXPORT_WORKERS = 1
+
+# also write the spikes of each shank as .npy files (times, features, masks
+# and waves, to load with np.load(..., mmap_mode='r')), in the directory
+# OUTPUT_NAME_npy with a manifest.json file of the parameters, the probe and
+# the arrays
+WRITE_NPY_FILES = False
+
+# coarse index of the spikes of each shank, the table index next to its
+# spike table in the .main.h5 file: for every block of INDEX_BLOCKSIZE spikes
+# the first and last times, the number of spikes on each channel and the
+# histogram of the peak amplitudes in INDEX_AMPLITUDE_BINS logarithmic bins
+# from 1 to 2**15, to seek time ranges and count spikes without reading them
+INDEX_BLOCKSIZE = 1024
+INDEX_AMPLITUDE_BINS = 32
+
+# also write the times, masks and filtered waves of the spikes to the file
+# OUTPUT_NAME.live.h5 as they are found, in HDF5 single writer multiple
+# readers (SWMR) mode, flushed after each chunk, so that viewers can follow
+# the spikes while detection runs (see reader.LiveSpikes). Needs h5py built
+# with HDF5 1.10 or later. The file is removed at the end with the other
+# HDF5 files unless KEEP_OLD_HDF5_FILES
+LIVE_HDF5 = False
+
 # Maximum number of spikes to process
 MAX_SPIKES = None  # None for all spikes, or an int
 
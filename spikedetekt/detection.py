@@ -0,0 +1,308 @@
+'''
+Filtering, thresholding and flood filling of the data, chunk by chunk.
+
+Iterating over a ChunkDetector gives the connected components of each chunk,
+which the callers then turn into spikes (core.extract_spike_batches) or just
+peak times (core.spike_detection_only).
+'''
+import numpy as np
+from parameters import Parameters
+from files import (num_samples, get_chunk_for_thresholding, chunks,
+                   FilWriter)
+from filtering import apply_filtering, get_filter_params
+from floodfill import connected_components, split_component
+from graphs import complete_if_none
+from debug import plot_diagnostics
+
+__all__ = ['get_threshold', 'threshold_crossings', 'dilate',
+           'artifact_samples', 'detect_window', 'coarse_windows',
+           'coarse_components', 'ChunkDetector']
+
+
+def get_threshold(DatFileNames, n_ch_dat, ChannelsToUse, filter_params):
+    '''
+    Returns a pair (Threshold, ThresholdSDFactor) computed from the start of
+    the first dat file, where ThresholdSDFactor is the estimated standard
+    deviation of the filtered signal (per channel unless
+    USE_SINGLE_THRESHOLD).
+    '''
+    THRESH_SD = Parameters['THRESH_SD']
+    # Just use first dat file for getting the thresholding data
+    with open(DatFileNames[0], 'rb') as fd:
+        # Use 5 chunks to figure out threshold
+        DatChunk = get_chunk_for_thresholding(fd, n_ch_dat, ChannelsToUse,
+                                              num_samples(DatFileNames[0],
+                                                          n_ch_dat))
+        FilteredChunk = apply_filtering(filter_params, DatChunk)
+        # .6745 converts median to standard deviation
+        if Parameters['USE_SINGLE_THRESHOLD']:
+            ThresholdSDFactor = np.median(np.abs(FilteredChunk)) / .6745
+        else:
+            ThresholdSDFactor = np.median(
+                np.abs(FilteredChunk),
+                axis=0) / .6745
+        Threshold = ThresholdSDFactor * THRESH_SD
+
+        print 'Threshold = ', Threshold, '\n'
+        # Record the absolute Threshold used
+        Parameters['THRESHOLD'] = Threshold
+    return Threshold, ThresholdSDFactor
+
+
+def threshold_crossings(FilteredArr, Threshold):
+    '''
+    Returns the int8 array which is 1 where FilteredArr crosses Threshold.
+    '''
+    if Parameters['DETECT_POSITIVE']:
+        BinaryArr = np.abs(FilteredArr) > Threshold
+    else:
+        BinaryArr = (FilteredArr < -Threshold)
+    return BinaryArr.astype(np.int8)
+
+
+def dilate(Mask, n):
+    '''
+    Returns the boolean array which is True within n samples of a True value
+    of Mask, in O(len(Mask)).
+    '''
+    if n <= 0:
+        return Mask.copy()
+    Cum = np.hstack((0, np.cumsum(Mask)))
+    i = np.arange(len(Mask))
+    return (Cum[np.minimum(i + n + 1, len(Mask))] -
+            Cum[np.maximum(i - n, 0)]) > 0
+
+
+def artifact_samples(BinaryArr, DatArr):
+    '''
+    Returns the boolean array of samples to reject as artifacts, those where at
+    least ARTIFACT_CHANNEL_FRACTION of the channels cross threshold at once or
+    where the raw data reaches ARTIFACT_SATURATION on any channel (if it is not
+    None), padded by S_ARTIFACT_PADDING samples on each side.
+    '''
+    n_ch = BinaryArr.shape[1]
+    Rejected = (BinaryArr.sum(axis=1) >=
+                Parameters['ARTIFACT_CHANNEL_FRACTION'] * n_ch)
+    saturation = Parameters['ARTIFACT_SATURATION']
+    if saturation is not None:
+        Rejected |= (np.abs(DatArr) >= saturation).any(axis=1)
+    return dilate(Rejected, Parameters['S_ARTIFACT_PADDING'])
+
+
+def detect_window(FilteredArr, DatArr, Threshold, ChannelGraph, s_join):
+    '''
+    Thresholds FilteredArr, blanks artifacts if REJECT_ARTIFACTS and flood
+    fills. Returns a tuple (IndLists, BinaryArr, Rejected) where Rejected is
+    the boolean array of rejected samples, or None.
+    '''
+    BinaryArr = threshold_crossings(FilteredArr, Threshold)
+    Rejected = None
+    if Parameters['REJECT_ARTIFACTS']:
+        Rejected = artifact_samples(BinaryArr, DatArr)
+        BinaryArr[Rejected] = 0
+    IndLists = connected_components(BinaryArr, ChannelGraph, s_join)
+    return IndLists, BinaryArr, Rejected
+
+
+def coarse_windows(FilteredChunk, Threshold, decimation, s_join):
+    '''
+    Returns a list of pairs (start, end) of the windows of FilteredChunk which
+    may contain threshold crossings.
+
+    The chunk is decimated into blocks of decimation samples, and the minimum
+    (or maximum absolute value for DETECT_POSITIVE) over each block is
+    compared to the threshold, so no crossing is ever missed. Candidate blocks
+    closer than s_join samples are put in the same window, so that flood
+    filling each window separately finds the same components as flood filling
+    the whole chunk. Windows have margins of s_join+1 samples on each side, so
+    that flood filling never looks back past the start of a window. Margins
+    of neighbouring windows may overlap but never contain crossings.
+    '''
+    n_s, n_ch = FilteredChunk.shape
+    n_full = n_s // decimation
+    # view of the chunk as whole blocks, the remainder is one last block
+    Blocks = FilteredChunk[:n_full * decimation].reshape(n_full, decimation,
+                                                         n_ch)
+    Tail = FilteredChunk[n_full * decimation:]
+    if Parameters['DETECT_POSITIVE']:
+        Envelope = -np.maximum(Blocks.max(axis=1), -Blocks.min(axis=1))
+        if len(Tail):
+            Envelope = np.vstack((Envelope, -np.abs(Tail).max(axis=0)))
+    else:
+        Envelope = Blocks.min(axis=1)
+        if len(Tail):
+            Envelope = np.vstack((Envelope, Tail.min(axis=0)))
+    Candidates = (Envelope < -Threshold).any(axis=1)
+    blocks, = Candidates.nonzero()
+    if not len(blocks):
+        return []
+    # two crossings s_join apart can be in blocks up to this many blocks apart
+    max_gap = int(s_join) // decimation + 1
+    breaks, = (np.diff(blocks) > max_gap).nonzero()
+    starts = np.hstack((blocks[0], blocks[breaks + 1]))
+    ends = np.hstack((blocks[breaks], blocks[-1])) + 1
+    return [(max(start * decimation - int(s_join) - 1, 0),
+             min(end * decimation + int(s_join) + 1, n_s))
+            for start, end in zip(starts, ends)]
+
+
+def coarse_components(FilteredChunk, DatChunk, Threshold, ChannelGraph,
+                      s_join):
+    '''
+    Coarse to fine version of detect_window for a whole chunk, which only
+    works at full resolution on the windows returned by coarse_windows.
+    Samples further than the margins from any crossing are never rejected as
+    artifacts.
+    '''
+    BinaryChunk = np.zeros(FilteredChunk.shape, dtype=np.int8)
+    Rejected = None
+    s_margin = s_join
+    if Parameters['REJECT_ARTIFACTS']:
+        Rejected = np.zeros(len(FilteredChunk), dtype=np.bool8)
+        # artifact padding must stay within the windows
+        s_margin = max(s_join, Parameters['S_ARTIFACT_PADDING'])
+    IndListsChunk = []
+    for start, end in coarse_windows(FilteredChunk, Threshold,
+                                     Parameters['COARSE_DECIMATION'],
+                                     s_margin):
+        IndLists, BinaryWindow, RejectedWindow = detect_window(
+            FilteredChunk[start:end], DatChunk[start:end], Threshold,
+            ChannelGraph, s_join)
+        BinaryChunk[start:end] |= BinaryWindow
+        if Rejected is not None:
+            Rejected[start:end] |= RejectedWindow
+        for IndList in IndLists:
+            IndListsChunk.append([(i_s + start, i_ch)
+                                  for i_s, i_ch in IndList])
+    return IndListsChunk, BinaryChunk, Rejected
+
+
+class ChunkDetector(object):
+
+    '''
+    Usage::
+
+        detector = ChunkDetector(DatFileNames, n_ch_dat, ChannelsToUse,
+                                 ChannelGraph)
+        for (DatChunk, FilteredChunk, IndListsChunk,
+             s_start, s_end, keep_start, keep_end) in detector:
+            ...
+
+    IndListsChunk is the list of connected components of the chunk, each a
+    list of pairs (sample, channel) relative to s_start. The filtered data is
+    written to the .fil file on the way. The thresholds are available as
+    detector.Threshold and detector.ThresholdSDFactor, and the channel graph
+    used for flood filling as detector.ChannelGraph.
+
+    With S_MAX_COMPONENT set, oversized components are split with
+    floodfill.split_component, the number of extra components this creates
+    is counted in detector.n_splits, and the number of pieces left oversized
+    (without a minimum to split at) in detector.n_unsplit.
+
+    With REJECT_ARTIFACTS, the crossings of samples rejected as artifacts are
+    blanked before flood filling, and the rejected intervals of samples (in
+    the whole recording, sorted, with end excluded) are accumulated in
+    detector.rejected_intervals.
+    '''
+
+    def __init__(self, DatFileNames, n_ch_dat, ChannelsToUse, ChannelGraph):
+        self.DatFileNames = DatFileNames
+        self.n_ch_dat = n_ch_dat
+        self.ChannelsToUse = ChannelsToUse
+        self.ChannelGraph = complete_if_none(ChannelGraph, Parameters['N_CH'])
+        # filter coefficents for the high pass filtering
+        self.filter_params = get_filter_params()
+        self.Threshold, self.ThresholdSDFactor = get_threshold(
+            DatFileNames, n_ch_dat, ChannelsToUse, self.filter_params)
+        self.rejected_intervals = []
+        self.n_splits = 0
+        self.n_unsplit = 0
+
+    def split_oversized(self, IndListsChunk):
+        '''
+        Returns IndListsChunk with the oversized components split.
+        '''
+        max_samples = Parameters['S_MAX_COMPONENT']
+        if max_samples is None:
+            return IndListsChunk
+        SplitLists = []
+        for IndList in IndListsChunk:
+            pieces = split_component(IndList, max_samples)
+            self.n_splits += len(pieces) - 1
+            for piece in pieces:
+                samps = [s for s, c in piece]
+                if max(samps) - min(samps) + 1 > max_samples:
+                    self.n_unsplit += 1
+            SplitLists.extend(pieces)
+        return SplitLists
+
+    def add_rejected(self, Rejected, s_start, keep_start, keep_end):
+        '''
+        Adds the intervals of True values of Rejected (a chunk starting at
+        s_start) inside [keep_start, keep_end) to rejected_intervals.
+        '''
+        Rejected = Rejected[keep_start - s_start:keep_end - s_start]
+        edges, = np.diff(np.hstack((0, Rejected, 0)).astype(np.int8)).nonzero()
+        for start, end in edges.reshape(-1, 2) + keep_start:
+            start, end = int(start), int(end)
+            intervals = self.rejected_intervals
+            if intervals and intervals[-1][1] == start:
+                intervals[-1] = (intervals[-1][0], end)
+            else:
+                intervals.append((start, end))
+
+    def __iter__(self):
+        S_JOIN_CC = Parameters['S_JOIN_CC']
+        Threshold = self.Threshold
+        # m A code that writes out a high-pass filtered version of the raw
+        # data (.fil file)
+        fil_writer = FilWriter(self.DatFileNames, self.n_ch_dat)
+        for (DatChunk, s_start, s_end,
+             keep_start, keep_end) in chunks(self.DatFileNames,
+                                             self.n_ch_dat,
+                                             self.ChannelsToUse):
+            ############## FILTERING ########################################
+            FilteredChunk = apply_filtering(self.filter_params, DatChunk)
+
+            # write filtered output to file
+            # if Parameters['WRITE_FIL_FILE']:
+            fil_writer.write(FilteredChunk, s_start, s_end,
+                             keep_start, keep_end)
+
+            ############## THRESHOLDING AND FLOOD FILL #####################
+            if Parameters['USE_COARSE_DETECTION']:
+                IndListsChunk, BinaryChunk, Rejected = coarse_components(
+                    FilteredChunk, DatChunk, Threshold, self.ChannelGraph,
+                    S_JOIN_CC)
+            else:
+                IndListsChunk, BinaryChunk, Rejected = detect_window(
+                    FilteredChunk, DatChunk, Threshold, self.ChannelGraph,
+                    S_JOIN_CC)
+            if Rejected is not None:
+                self.add_rejected(Rejected, s_start, keep_start, keep_end)
+            IndListsChunk = self.split_oversized(IndListsChunk)
+            # write binary chunk filtered output to file
+            if Parameters['WRITE_BINFIL_FILE']:
+                fil_writer.write_bin(
+                    BinaryChunk,
+                    s_start,
+                    s_end,
+                    keep_start,
+                    keep_end)
+            if Parameters['DEBUG']:
+                plot_diagnostics(
+                    s_start,
+                    IndListsChunk,
+                    BinaryChunk,
+                    DatChunk,
+                    FilteredChunk,
+                    Threshold)
+                fil_writer.write_bin(
+                    BinaryChunk,
+                    s_start,
+                    s_end,
+                    keep_start,
+                    keep_end)
+
+            yield (DatChunk, FilteredChunk, IndListsChunk,
+                   s_start, s_end, keep_start, keep_end)
@@ -22,6 +22,84 @@ def compute_pcs(X_ns):
     return Vecs.astype(np.float32).T[np.argsort(Vals)[::-1]]
 
 
+class CovarianceAccumulator(object):
+
+    '''
+    Accumulates in float64 the sums and cross products over spikes of the
+    waves on each channel, to compute the covariance matrices and principal
+    components of all channels at once.
+
+    Usage::
+
+        acc = CovarianceAccumulator(n_samples, n_channels)
+        acc.add(X_nsc)
+        ...
+        PC_fsc = acc.pcs(FPC)
+    '''
+
+    def __init__(self, n_samples, n_channels):
+        self.n = 0
+        self.sum_cs = np.zeros((n_channels, n_samples))
+        self.prod_css = np.zeros((n_channels, n_samples, n_samples))
+
+    def add(self, X_nsc, blocksize=1000):
+        '''
+        Adds the waves X_nsc, of shape (n_spikes, n_samples, n_channels).
+        '''
+        for i in xrange(0, len(X_nsc), blocksize):
+            # one float64 copy of the block, channels first for matmul
+            X_csn = np.array(X_nsc[i:i + blocksize].transpose(2, 1, 0),
+                             dtype=np.float64, order='C')
+            self.n += X_csn.shape[2]
+            self.sum_cs += X_csn.sum(axis=2)
+            self.prod_css += np.matmul(X_csn, X_csn.transpose(0, 2, 1))
+
+    def covariances(self):
+        '''
+        Returns the covariance matrices, of shape (n_channels, n_samples,
+        n_samples).
+        '''
+        mean_cs = self.sum_cs / self.n
+        return ((self.prod_css -
+                 self.n * mean_cs[:, :, np.newaxis] * mean_cs[:, np.newaxis, :])
+                / (self.n - 1))
+
+    def pcs(self, n_pcs):
+        '''
+        Returns the first n_pcs principal components of each channel, as an
+        array of shape (n_pcs, n_samples, n_channels), in decreasing order of
+        eigenvalue. They are computed with a full eigh of the covariance
+        matrices, or with randomized_eigh if PCA_SOLVER is 'randomized'.
+        '''
+        if Parameters['PCA_SOLVER'] == 'randomized':
+            PC_csf = randomized_eigh(self.covariances(), n_pcs)
+        else:
+            # batched over channels, eigenvalues in increasing order
+            Vals, Vecs_css = np.linalg.eigh(self.covariances())
+            PC_csf = Vecs_css[:, :, ::-1][:, :, :n_pcs]
+        return PC_csf.transpose(2, 1, 0).astype(np.float32)
+
+
+def randomized_eigh(Cov_css, k, n_oversamples=10, n_iter=3, seed=0):
+    '''
+    Returns the top k eigenvectors of each of the symmetric positive
+    semidefinite matrices Cov_css (shape (n_ch, s, s)), as an array of shape
+    (n_ch, s, k) in decreasing order of eigenvalue, with a randomized range
+    finder and n_iter power iterations, batched over channels.
+    '''
+    n_ch, s, _ = Cov_css.shape
+    l = min(k + n_oversamples, s)
+    Omega = np.random.RandomState(seed).randn(n_ch, s, l)
+    # orthonormal bases of the ranges, via the (batched) thin SVD
+    Q = np.linalg.svd(np.matmul(Cov_css, Omega), full_matrices=False)[0]
+    for _ in xrange(n_iter):
+        Q = np.linalg.svd(np.matmul(Cov_css, Q), full_matrices=False)[0]
+    # exact eigendecomposition of the small projected matrices
+    B = np.matmul(Q.transpose(0, 2, 1), np.matmul(Cov_css, Q))
+    Vals, W = np.linalg.eigh(B)
+    return np.matmul(Q, W[:, :, ::-1][:, :, :k])
+
+
 def reget_features(X_nsc):
     FPC = Parameters['FPC']
    # PC_3s = compute_pcs(X_nsc[:,:,0])[:FPC]  # FPC x Parameters['S_TOTAL']
@@ -29,8 +107,11 @@ def reget_features(X_nsc):
     n_livech = X_nsc.shape[2]
     s_tot = Parameters['S_TOTAL']
     PC_3s = np.zeros((FPC, s_tot, n_livech))
-    for j in xrange(n_livech):
-        PC_3s[:,:, j] = compute_pcs(X_nsc[:,:, j])[:FPC]  # FPC x Parameters['S_TOTAL'] x Parameters['N_CH']
+    # the covariances of all channels are computed together, rather than
+    # calling compute_pcs for each channel
+    acc = CovarianceAccumulator(s_tot, n_livech)
+    acc.add(X_nsc)
+    PC_3s[:] = acc.pcs(FPC)  # FPC x Parameters['S_TOTAL'] x Parameters['N_CH']
     print 'PC_3s', PC_3s.shape
     # Number of spikes x Number of samples per Spike x Parameters['N_CH']
     print 'X_nsc', X_nsc.shape
@@ -48,3 +129,168 @@ def project_features(PC_3s, X_sc):
     return (
         100. * np.einsum('ijk,jk->ki', PC_3s, X_sc)  # Notice the transposition
     )
+
+
+def project_features_block(PC_3s, X_nsc):
+    '''
+    Projects a block of waves X_nsc, of shape (n_spikes, S_TOTAL, n_ch), at
+    once. Returns an array of shape (n_spikes, n_ch*FPC) whose rows are
+    project_features(PC_3s, X_nsc[i]).flatten().
+    '''
+    n_spikes, s_tot, n_ch = X_nsc.shape
+    PC_csf = np.ascontiguousarray(PC_3s.transpose(2, 1, 0), dtype=np.float64)
+    X_cns = np.array(X_nsc.transpose(2, 0, 1), dtype=np.float64, order='C')
+    # batched over channels: (n_ch, n_spikes, S_TOTAL) x (n_ch, S_TOTAL, FPC)
+    F_cnf = np.matmul(X_cns, PC_csf)
+    return 100. * F_cnf.transpose(1, 0, 2).reshape(n_spikes, -1)
+
+
+class PCTrainer(object):
+
+    '''
+    Trains the principal components of a shank from the waves passed to add
+    during detection, with bounded memory, so that they are ready as soon as
+    detection ends without reading the waves back.
+
+    With mode 'reservoir' a uniform random sample of maxwaves waves of the
+    whole recording is kept (reservoir sampling), with mode 'all' the
+    covariances are accumulated over every wave.
+    '''
+
+    def __init__(self, n_samples, n_channels, mode='reservoir',
+                 maxwaves=10000, seed=0):
+        if mode not in ('reservoir', 'all'):
+            raise ValueError("Unknown PCA training mode " + repr(mode))
+        self.mode = mode
+        self.maxwaves = maxwaves
+        self.n_seen = 0
+        if mode == 'all':
+            self.acc = CovarianceAccumulator(n_samples, n_channels)
+        else:
+            # grown as needed up to maxwaves waves
+            self.reservoir = np.zeros((0, n_samples, n_channels),
+                                      dtype=np.float32)
+            self.rng = np.random.RandomState(seed)
+
+    def add(self, X_nsc):
+        '''
+        Adds the waves X_nsc, of shape (n_spikes, n_samples, n_channels).
+        '''
+        n = len(X_nsc)
+        if self.mode == 'all':
+            self.acc.add(X_nsc)
+        else:
+            # the t-th wave seen goes in slot t while the reservoir is not
+            # full, and afterwards replaces a random slot with probability
+            # maxwaves/(t+1)
+            t = self.n_seen + np.arange(n)
+            slots = np.where(t < self.maxwaves, t,
+                             (self.rng.random_sample(n) * (t + 1)).astype(int))
+            keep = slots < self.maxwaves
+            n_filled = min(self.n_seen + n, self.maxwaves)
+            if n_filled > len(self.reservoir):
+                size = min(max(n_filled, 2 * len(self.reservoir)),
+                           self.maxwaves)
+                grown = np.zeros((size,) + self.reservoir.shape[1:],
+                                 dtype=np.float32)
+                grown[:len(self.reservoir)] = self.reservoir
+                self.reservoir = grown
+            # with repeated slots the later wave wins, as when done in order
+            self.reservoir[slots[keep]] = X_nsc[keep]
+        self.n_seen += n
+
+    def pcs(self):
+        '''
+        Returns the principal components PC_3s as reget_features does.
+        '''
+        if self.mode == 'reservoir':
+            return reget_features(
+                self.reservoir[:min(self.n_seen, self.maxwaves)])
+        FPC = Parameters['FPC']
+        PC_3s = np.zeros((FPC,) + self.acc.sum_cs.shape[::-1])
+        PC_3s[:] = self.acc.pcs(FPC)
+        return PC_3s
+
+
+class SinglePassFeatures(object):
+
+    '''
+    Computes the features of a shank during detection, so that the waves are
+    only read once. The principal components are trained on the first
+    n_initial waves, and every wave is projected as soon as they are known.
+    The covariances of all waves are accumulated too, so that the drift of
+    the components over the recording can be measured at the end.
+
+    Usage::
+
+        sp = SinglePassFeatures(n_samples, n_channels, n_initial)
+        for X_nsc, item in ...:
+            for item, features in sp.add(X_nsc, item):
+                ...
+        for item, features in sp.finish():
+            ...
+        if sp.drift() > tolerance:
+            PC_3s = sp.final_pcs()
+            ...
+
+    where features has shape (len(X_nsc), n_channels*FPC) as returned by
+    project_features_block.
+    '''
+
+    def __init__(self, n_samples, n_channels, n_initial):
+        self.n_initial = n_initial
+        self.acc = CovarianceAccumulator(n_samples, n_channels)
+        self.PC_3s = None
+        self.queue = []
+        self.n_queued = 0
+
+    def add(self, X_nsc, item):
+        '''
+        Queues item, the object the waves X_nsc belong to, and returns the
+        list of pairs (item, features) whose features are now known, in the
+        order they were added.
+        '''
+        self.acc.add(X_nsc)
+        self.queue.append((X_nsc, item))
+        self.n_queued += len(X_nsc)
+        if self.PC_3s is None and self.n_queued < self.n_initial:
+            return []
+        return self.finish()
+
+    def finish(self):
+        '''
+        Trains the principal components on the queued waves if that is not
+        done yet, and returns the remaining pairs (item, features).
+        '''
+        if self.PC_3s is None:
+            if not self.queue:
+                return []
+            self.PC_3s = reget_features(
+                np.concatenate([X for X, item in self.queue])[:self.n_initial])
+        done = [(item, project_features_block(self.PC_3s, X))
+                for X, item in self.queue]
+        self.queue = []
+        return done
+
+    def final_pcs(self):
+        '''
+        Returns the principal components of all the waves, as PC_3s.
+        '''
+        FPC = Parameters['FPC']
+        PC_3s = np.zeros(self.PC_3s.shape)
+        PC_3s[:] = self.acc.pcs(FPC)
+        return PC_3s
+
+    def drift(self):
+        '''
+        Returns the largest relative loss, over channels, of the variance of
+        all the waves explained by the principal components used, compared to
+        the principal components of all the waves.
+        '''
+        Cov_css = self.acc.covariances()
+        U_csf = self.PC_3s.transpose(2, 1, 0)
+        V_csf = self.final_pcs().transpose(2, 1, 0)
+        used = np.einsum('csf,cst,ctf->c', U_csf, Cov_css, U_csf)
+        best = np.einsum('csf,cst,ctf->c', V_csf, Cov_css, V_csf)
+        loss = np.where(best > 0, 1 - used / np.where(best > 0, best, 1), 0)
+        return max(loss.max(), 0)
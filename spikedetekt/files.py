@@ -2,13 +2,19 @@
 File handling routines, to separate data access from algorithm details.
 '''
 import os
+import json
+import h5py
 from utils import basename_noext
-from tables import IsDescription, Int32Col, Float32Col, Int8Col
+from tables import (IsDescription, Int64Col, Int32Col, Int16Col, Float32Col,
+                    Int8Col, Filters, whichLibVersion, Atom, Group, openFile)
+from multiprocessing import Pool
 import numpy as np
 from xml.etree.ElementTree import ElementTree, Element, SubElement
 from utils import switch_ext
 import os.path
 from parameters import Parameters
+from log import log_warning
+from features import project_features_block
 
 # m chops n_samples into chunks according to chunk_size,overlap
 # m Overlap probably controls for the artifacts of filtering on the ends
@@ -212,65 +218,1052 @@ def get_chunk_for_thresholding(fd, n_ch_dat, ChannelsToUse, n_samples):
 
 
 def shank_description(shanksize):
-    s_total = Parameters['S_TOTAL']
     fpc = Parameters['FPC']
     print 'shanksize = ', shanksize
      #n_ch,  fpc ,s_total  = eval('(N_CH, FPC, S_TOTAL)', Parameters)
 
     class description(IsDescription):
-        time = Int32Col()
+        time = Int64Col()
         mask_binary = Int8Col(shape=(shanksize,))
         mask_float = Float32Col(shape=(shanksize,))
         features = Float32Col(shape=(1 + fpc * shanksize,))
-        PC_3s = Float32Col(shape=(fpc * s_total * shanksize,))
     return description
 
 
 def waveform_description(shanksize):
     s_total = Parameters['S_TOTAL']
+    if Parameters['INT16_WAVES']:
+        Col = Int16Col
+    else:
+        Col = Float32Col
 
     class description(IsDescription):
-        wave = Float32Col(shape=(s_total, shanksize))
-        unfiltered_wave = Float32Col(shape=(s_total, shanksize))
+        wave = Col(shape=(s_total, shanksize))
+        unfiltered_wave = Col(shape=(s_total, shanksize))
     return description
 
 
-def klusters_files(h5s, shank_table, basename, probe):
-    N_CH, FPC = eval('(N_CH, FPC)', Parameters)
+class RaggedTable(object):
+
+    '''
+    Base class of the ragged storage of spikes, where only some channels of
+    each spike are stored, in an HDF5 group with the extendable arrays:
+
+    channels
+        The channel (in the shank) of each stored entry, shape (nnz,).
+    offsets
+        The entries of spike i are offsets[i]:offsets[i+1], shape
+        (n_spikes+1,).
+
+    and arrays of values, one row per entry, defined by the subclasses. It is
+    used like a dense PyTables table: rows are appended and read as record
+    arrays of dtype self.dtype, with zeros on the channels not stored, and
+    t.cols.name[start:stop] reads a single column.
+    '''
+
+    def __init__(self, group):
+        self.group = group
+        self.channels = group.channels
+        self.offsets = group.offsets
+        self.n_values = int(self.offsets[-1])
+        self.shanksize = group._v_attrs.shanksize
+        self.cols = SparseColumns(self)
+
+    @staticmethod
+    def create_index(h5, group, shanksize, filters, expectedrows):
+        group._v_attrs.shanksize = shanksize
+        h5.createEArray(group, 'channels', Atom.from_dtype(np.dtype(np.int16)),
+                        (0,), filters=filters,
+                        expectedrows=expectedrows * shanksize)
+        offsets = h5.createEArray(group, 'offsets',
+                                  Atom.from_dtype(np.dtype(np.int64)), (0,),
+                                  filters=filters, expectedrows=expectedrows)
+        offsets.append(np.zeros(1, dtype=np.int64))
+
+    @property
+    def attrs(self):
+        return self.group._v_attrs
+
+    @property
+    def rowsize(self):
+        return self.dtype.itemsize
+
+    def __len__(self):
+        return self.offsets.nrows - 1
+
+    def __getitem__(self, key):
+        return self.read(key)
+
+    def append_index(self, spike, channel, n_spikes):
+        '''
+        Appends the entries (spike, channel), spike being the index in the
+        n_spikes rows appended, in increasing order.
+        '''
+        self.channels.append(channel.astype(np.int16))
+        counts = np.bincount(spike, minlength=n_spikes)
+        self.offsets.append(self.n_values + np.cumsum(counts))
+        self.n_values += len(spike)
+
+    def read_index(self, key):
+        '''
+        Returns (rows, scalar, spike, channel, start, stop, value) for the
+        rows key (an int, a slice or an array of indices): rows the array of
+        indices, scalar whether key is an int, start:stop the contiguous
+        range of entries spanning those rows, and for each entry of the rows
+        the index in rows of its spike, its channel and its index value in
+        the range start:stop.
+        '''
+        rows = np.arange(len(self))[key]
+        scalar = np.ndim(rows) == 0
+        rows = np.atleast_1d(rows)
+        if not len(rows):
+            empty = np.zeros(0, dtype=int)
+            return rows, scalar, empty, empty, 0, 0, empty
+        lo, hi = rows.min(), rows.max() + 1
+        offsets = self.offsets[lo:hi + 1]
+        start, stop = offsets[0], offsets[-1]
+        counts = np.diff(offsets)[rows - lo]
+        spike = np.repeat(np.arange(len(rows)), counts)
+        first = offsets[rows - lo] - start
+        value = (np.repeat(first - np.cumsum(counts) + counts, counts) +
+                 np.arange(counts.sum()))
+        channel = self.channels[start:stop][value]
+        return rows, scalar, spike, channel, start, stop, value
+
+
+class SparseWaveTable(RaggedTable):
+
+    '''
+    Ragged storage of the waves of a shank, with only the channels of the
+    channel mask of each spike. Rows have the wave and unfiltered_wave
+    columns of waveform_description() and a channel_mask column. The waves
+    are stored in the arrays wave and unfiltered_wave, of shape (nnz,
+    S_TOTAL).
+
+    Usage::
+
+        t = SparseWaveTable.create(h5, where, 'waveforms', shanksize)
+        t.append(rows)
+        t.cols.wave[start:stop]
+        t[indices]
+        t = SparseWaveTable(h5.getNode(where, 'waveforms'))
+    '''
+
+    columns = ('wave', 'unfiltered_wave')
+
+    def __init__(self, group):
+        RaggedTable.__init__(self, group)
+        self.values = dict((name, getattr(group, name))
+                           for name in self.columns)
+        s_total = self.values['wave'].shape[1]
+        atom_dtype = self.values['wave'].atom.dtype
+        self.dtype = np.dtype([
+            ('wave', atom_dtype, (s_total, self.shanksize)),
+            ('unfiltered_wave', atom_dtype, (s_total, self.shanksize)),
+            ('channel_mask', np.int8, (self.shanksize,))])
+
+    @classmethod
+    def create(cls, h5, where, name, shanksize, filters=None,
+               expectedrows=10000):
+        '''
+        Creates the group and arrays of a new table of shanksize channels.
+        '''
+        group = h5.createGroup(where, name)
+        description = waveform_description(shanksize)
+        atom = Atom.from_dtype(description.columns['wave'].dtype.base)
+        for column in cls.columns:
+            h5.createEArray(group, column, atom,
+                            (0, Parameters['S_TOTAL']), filters=filters,
+                            expectedrows=expectedrows * shanksize)
+        cls.create_index(h5, group, shanksize, filters, expectedrows)
+        return cls(group)
+
+    def append(self, rows):
+        # row major order keeps the channels of each spike together
+        spike, channel = (rows['channel_mask'] != 0).nonzero()
+        for name in self.columns:
+            self.values[name].append(rows[name][spike, :, channel])
+        self.append_index(spike, channel, len(rows))
+
+    def flush(self):
+        for name in self.columns:
+            self.values[name].flush()
+        self.channels.flush()
+        self.offsets.flush()
+
+    def read(self, key, names=None):
+        '''
+        Returns the rows key (an int, a slice or an array of indices) as a
+        record array with zeros on the masked channels, with only the waves
+        of the columns names if given.
+        '''
+        if names is None:
+            names = self.columns
+        rows, scalar, spike, channel, start, stop, value = self.read_index(key)
+        out = np.zeros(len(rows), dtype=self.dtype)
+        out['channel_mask'][spike, channel] = 1
+        for name in names:
+            if name in self.columns:
+                out[name][spike, :, channel] = \
+                    self.values[name][start:stop][value]
+        if scalar:
+            return out[0]
+        return out
+
+
+class SparseFeatureTable(RaggedTable):
+
+    '''
+    Ragged storage of the spikedetekt table of a shank, with the features and
+    masks of only the channels where the binary or float mask is nonzero.
+    Rows have the columns of shank_description(). The arrays are time, of
+    shape (n_spikes,), and features, mask_binary and mask_float, of shapes
+    (nnz, FPC), (nnz,) and (nnz,). The last feature, the time, is not stored.
+
+    Usage::
+
+        t = SparseFeatureTable.create(h5, where, 'spikedetekt', description)
+        t.append(rows)
+        t.modifyColumn(start, stop, column=features, colname='features')
+        t.cols.features[start:stop]
+        t = SparseFeatureTable(h5.getNode(where, 'spikedetekt'))
+    '''
+
+    columns = ('features', 'mask_binary', 'mask_float')
+
+    def __init__(self, group):
+        RaggedTable.__init__(self, group)
+        self.time = group.time
+        self.values = dict((name, getattr(group, name))
+                           for name in self.columns)
+        self.fpc = self.values['features'].shape[1]
+        n = self.shanksize
+        self.dtype = np.dtype([
+            ('time', self.time.atom.dtype),
+            ('mask_binary', np.int8, (n,)),
+            ('mask_float', np.float32, (n,)),
+            ('features', np.float32, (1 + self.fpc * n,))])
+
+    @classmethod
+    def create(cls, h5, where, name, description, filters=None,
+               expectedrows=10000):
+        '''
+        Creates the group and arrays of a new table for the description
+        returned by shank_description().
+        '''
+        group = h5.createGroup(where, name)
+        shanksize = description.columns['mask_binary'].shape[0]
+        fpc = (description.columns['features'].shape[0] - 1) // shanksize
+        nnz = expectedrows * shanksize
+        h5.createEArray(group, 'time',
+                        Atom.from_dtype(description.columns['time'].dtype),
+                        (0,), filters=filters, expectedrows=expectedrows)
+        h5.createEArray(group, 'features', Atom.from_dtype(np.dtype(np.float32)),
+                        (0, fpc), filters=filters, expectedrows=nnz)
+        h5.createEArray(group, 'mask_binary', Atom.from_dtype(np.dtype(np.int8)),
+                        (0,), filters=filters, expectedrows=nnz)
+        h5.createEArray(group, 'mask_float',
+                        Atom.from_dtype(np.dtype(np.float32)),
+                        (0,), filters=filters, expectedrows=nnz)
+        cls.create_index(h5, group, shanksize, filters, expectedrows)
+        return cls(group)
+
+    def append(self, rows):
+        spike, channel = ((rows['mask_binary'] != 0) |
+                          (rows['mask_float'] != 0)).nonzero()
+        features = rows['features'][:, :-1].reshape(len(rows),
+                                                     self.shanksize, self.fpc)
+        self.time.append(rows['time'])
+        self.values['features'].append(features[spike, channel])
+        for name in ('mask_binary', 'mask_float'):
+            self.values[name].append(rows[name][spike, channel])
+        self.append_index(spike, channel, len(rows))
+
+    def modifyColumn(self, start, stop, column, colname):
+        '''
+        Replaces the features of the rows start:stop, as Table.modifyColumn
+        (only for the features column).
+        '''
+        if colname != 'features':
+            raise ValueError('Only the features can be modified, not ' +
+                             colname)
+        offsets = self.offsets[start:stop + 1]
+        spike = np.repeat(np.arange(stop - start), np.diff(offsets))
+        channel = self.channels[offsets[0]:offsets[-1]]
+        features = column[:, :-1].reshape(len(column),
+                                          self.shanksize, self.fpc)
+        self.values['features'][offsets[0]:offsets[-1]] = \
+            features[spike, channel]
+
+    def flush(self):
+        for name in self.columns:
+            self.values[name].flush()
+        self.time.flush()
+        self.channels.flush()
+        self.offsets.flush()
+
+    def read(self, key, names=None):
+        '''
+        Returns the rows key (an int, a slice or an array of indices) as a
+        record array with zeros on the channels not stored, with only the
+        columns names if given.
+        '''
+        if names is None:
+            names = self.dtype.names
+        rows, scalar, spike, channel, start, stop, value = self.read_index(key)
+        out = np.zeros(len(rows), dtype=self.dtype)
+        if len(rows):
+            lo = rows.min()
+            out['time'] = self.time[lo:rows.max() + 1][rows - lo]
+        if 'features' in names:
+            features = out['features'][:, :-1].reshape(len(rows),
+                                                       self.shanksize,
+                                                       self.fpc)
+            features[spike, channel] = \
+                self.values['features'][start:stop][value]
+            out['features'][:, -1] = out['time']
+        for name in ('mask_binary', 'mask_float'):
+            if name in names:
+                out[name][spike, channel] = self.values[name][start:stop][value]
+        if scalar:
+            return out[0]
+        return out
+
+
+class SparseColumns(object):
+
+    '''
+    The cols attribute of the ragged tables, so that t.cols.wave[start:stop]
+    reads only the wave column, as for a dense table.
+    '''
+
+    def __init__(self, table):
+        self.table = table
+
+    def __getattr__(self, name):
+        if name not in self.table.dtype.names:
+            raise AttributeError(name)
+        return SparseColumn(self.table, name)
+
+
+class SparseColumn(object):
+
+    def __init__(self, table, name):
+        self.table = table
+        self.name = name
+
+    def __len__(self):
+        return len(self.table)
+
+    def __getitem__(self, key):
+        return self.table.read(key, names=(self.name,))[self.name]
+
+
+def quantize_waves(waves, scale=1., offset=0.):
+    '''
+    Returns the waves as int16, such that waves ~ scale*quantized+offset,
+    clipped to the int16 range. With the default scale and offset this is the
+    conversion done when writing .spk files.
+    '''
+    waves = (waves - offset) / scale
+    return np.clip(waves, -32768, 32767).astype(np.int16)
+
+
+def wave_scale(table):
+    '''
+    Returns the pair (scale, offset) such that the filtered waves are
+    scale*wave+offset for the wave column of the waveforms table.
+    '''
+    attrs = table.attrs
+    return (getattr(attrs, 'wave_scale', 1.),
+            getattr(attrs, 'wave_offset', 0.))
+
+
+def description_dtype(description):
+    '''
+    Returns the numpy dtype of the rows of a table of the given description.
+    '''
+    return np.dtype([(name, col.dtype) for name, col in
+                     sorted(description.columns.iteritems())])
+
+
+def detection_description():
+
+    class description(IsDescription):
+        time = Int64Col(pos=0)
+        peak_channel = Int32Col(pos=1)
+        peak_amplitude = Float32Col(pos=2)
+        n_channels = Int32Col(pos=3)
+    return description
+
+
+def artifact_description():
+
+    class description(IsDescription):
+        start = Int64Col(pos=0)
+        end = Int64Col(pos=1)
+    return description
+
+
+def index_description(shanksize, n_bins):
+
+    class description(IsDescription):
+        start = Int64Col(pos=0)
+        stop = Int64Col(pos=1)
+        first_time = Int64Col(pos=2)
+        last_time = Int64Col(pos=3)
+        channel_count = Int32Col(shape=(shanksize,), pos=4)
+        amplitude_count = Int32Col(shape=(n_bins,), pos=5)
+    return description
+
+
+def amplitude_bins():
+    '''
+    Returns the edges of the INDEX_AMPLITUDE_BINS bins of the peak amplitudes
+    of the spike index, logarithmic from 1 to 2**15 (units of the raw data).
+    '''
+    return np.logspace(0, 15, Parameters['INDEX_AMPLITUDE_BINS'] + 1, base=2)
+
+
+def spike_amplitudes(waves, masks):
+    '''
+    Returns the peak amplitude of each spike, the largest absolute value of
+    its filtered wave, shape (n_spikes, S_TOTAL, shanksize), on the channels
+    of its binary mask.
+    '''
+    peaks = np.abs(waves).max(axis=1)
+    return np.where(masks, peaks, 0).max(axis=1)
+
+
+def expected_spikes(n_samples):
+    '''
+    Returns the number of spikes per shank expected in n_samples samples,
+    from EXPECTED_SPIKE_RATE.
+    '''
+    return int(n_samples / Parameters['SAMPLE_RATE'] *
+               Parameters['EXPECTED_SPIKE_RATE'])
+
+
+def table_sizes(description, expectedrows, chunk_bytes=256 * 1024):
+    '''
+    Returns a dictionary with the keyword arguments expectedrows and
+    chunkshape for createTable, for a table of the given description with
+    HDF5 chunks of about chunk_bytes bytes.
+    '''
+    rowsize = sum(col.dtype.itemsize
+                  for col in description().columns.values())
+    expectedrows = max(int(expectedrows), 1)
+    chunkrows = max(1, min(chunk_bytes // rowsize, expectedrows))
+    return dict(expectedrows=expectedrows, chunkshape=(chunkrows,))
+
+
+def table_filters():
+    '''
+    Returns the tables.Filters for the spikedetekt and waveforms tables, from
+    HDF5_COMPLIB, HDF5_COMPLEVEL and HDF5_SHUFFLE. Falls back to zlib if the
+    compression library is not available.
+    '''
+    complib = Parameters['HDF5_COMPLIB']
+    if Parameters['HDF5_COMPLEVEL'] and whichLibVersion(complib) is None:
+        log_warning('Compression library %s not available, using zlib' %
+                    complib)
+        complib = 'zlib'
+    return Filters(complevel=Parameters['HDF5_COMPLEVEL'], complib=complib,
+                   shuffle=Parameters['HDF5_SHUFFLE'])
+
+
+class BufferedTableWriter(object):
+
+    '''
+    Appends record arrays to a PyTables table in blocks of at least
+    buffer_bytes bytes, rather than for every call of append. Call flush
+    before reading from the table.
+    '''
+
+    def __init__(self, table, buffer_bytes=8 * 1024 * 1024):
+        self.table = table
+        self.buffer_rows = max(1, buffer_bytes // table.rowsize)
+        self.buffer = []
+        self.n_buffered = 0
+
+    def append(self, rows):
+        self.buffer.append(rows)
+        self.n_buffered += len(rows)
+        if self.n_buffered >= self.buffer_rows:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.table.append(np.concatenate(self.buffer))
+            self.buffer = []
+            self.n_buffered = 0
+        self.table.flush()
+
+
+class SpikeIndex(object):
+
+    '''
+    Coarse index of the spikes of a shank, written to the table index of its
+    group: for each block of blocksize spikes (in the order of the spike
+    tables), the rows start:stop, the first and last times, the number of
+    spikes on each channel and the histogram of the peak amplitudes over
+    amplitude_bins(). Usage::
+
+        index = SpikeIndex(shanksize)
+        index.add(times, masks, amplitudes)
+        ...
+        index.write(h5, shank_group)
+    '''
+
+    def __init__(self, shanksize, blocksize=None):
+        if blocksize is None:
+            blocksize = Parameters['INDEX_BLOCKSIZE']
+        self.blocksize = blocksize
+        self.bins = amplitude_bins()
+        self.description = index_description(shanksize, len(self.bins) - 1)
+        self.rows = []
+        self.pending = []
+        self.n_pending = 0
+        self.n_spikes = 0
+
+    def add(self, times, masks, amplitudes):
+        '''
+        Add spikes, with their times, binary masks of shape (n_spikes,
+        shanksize) and peak amplitudes.
+        '''
+        self.pending.append((times, masks, amplitudes))
+        self.n_pending += len(times)
+        if self.n_pending >= self.blocksize:
+            times, masks, amplitudes = [np.concatenate(x)
+                                        for x in zip(*self.pending)]
+            n = len(times) // self.blocksize * self.blocksize
+            for start in xrange(0, n, self.blocksize):
+                stop = start + self.blocksize
+                self.add_block(times[start:stop], masks[start:stop],
+                               amplitudes[start:stop])
+            self.pending = [(times[n:], masks[n:], amplitudes[n:])]
+            self.n_pending = len(times) - n
+
+    def add_block(self, times, masks, amplitudes):
+        counts, _ = np.histogram(np.clip(amplitudes, self.bins[0],
+                                         self.bins[-1]), self.bins)
+        self.rows.append((self.n_spikes, self.n_spikes + len(times),
+                          times[0], times[-1], (masks != 0).sum(axis=0),
+                          counts))
+        self.n_spikes += len(times)
+
+    def write(self, h5, group):
+        '''
+        Write the index, with the last incomplete block, to the table index
+        of group, with the blocksize and amplitude_bins attributes.
+        '''
+        if self.n_pending:
+            self.add_block(*[np.concatenate(x) for x in zip(*self.pending)])
+            self.pending = []
+            self.n_pending = 0
+        t = h5.createTable(group, 'index', self.description,
+                           expectedrows=max(len(self.rows), 1))
+        if self.rows:
+            t.append(np.array(self.rows, dtype=t.dtype))
+        t.attrs.blocksize = self.blocksize
+        t.attrs.amplitude_bins = self.bins
+        return t
+
+
+def open_shank_table(node):
+    '''
+    Returns the spikedetekt or waveforms table of a shank from its HDF5 node,
+    the node itself for a dense table, or the SparseFeatureTable or
+    SparseWaveTable of its group.
+    '''
+    if not isinstance(node, Group):
+        return node
+    if 'wave' in node:
+        return SparseWaveTable(node)
+    return SparseFeatureTable(node)
+
+
+# the Klusters files written for each shank, the .res and .clu files together
+KLUSTERS_EXPORTS = ['spk', 'uspk', 'fet', 'mask', 'fmask', 'res']
+
+
+def klusters_exports():
+    '''
+    Returns the Klusters files written for each shank.
+    '''
+    return [export for export in KLUSTERS_EXPORTS
+            if export != 'fmask' or Parameters['USE_FLOAT_MASKS']]
+
+
+def write_klusters_xml(probe, basename):
+    if Parameters['WRITE_XML_FILE']:
+        write_xml(probe,
+                  n_ch=Parameters['N_CH'],
+                  n_samp=Parameters['S_TOTAL'],
+                  n_feat=Parameters['FPC'],
+                  sample_rate=Parameters['SAMPLE_RATE'],
+                  filepath=basename + '.xml')
+
+
+def klusters_files(h5s, shank_table, basename, probe, blocksize=4096):
+    '''
+    Writes the .xml file, and the Klusters files of each shank from the open
+    tables of shank_table.
+    '''
+    write_klusters_xml(probe, basename)
+    for shank in probe.shanks_set:
+        for export in klusters_exports():
+            write_klusters_file(export, shank_table, shank, basename,
+                                blocksize)
+
+
+def klusters_files_parallel(h5s_filenames, basename, probe, n_workers,
+                            blocksize=4096):
+    '''
+    Writes the .xml file, and the Klusters files of each shank with n_workers
+    worker processes, one file at a time per worker. The HDF5 files, whose
+    names are in h5s_filenames, must be closed: each worker opens them
+    read-only.
+    '''
+    write_klusters_xml(probe, basename)
+    filenames = dict((key, h5s_filenames[key]) for key in ['main', 'waves'])
+    # the .spk and .uspk files are preallocated, and filled by ranges of
+    # spikes in parallel
+    waves_h5 = openFile(filenames['waves'], 'r')
+    shapes = dict((shank, spk_shape(open_shank_table(waves_h5.getNode(
+        '/shanks/shank_' + str(shank), 'waveforms'))))
+        for shank in probe.shanks_set)
+    waves_h5.close()
+    tasks = []
     for shank in probe.shanks_set:
-        T = shank_table['spikedetekt', shank]
-        write_fet(T.cols.features[:], basename + '.fet.' + str(shank))
+        for export in klusters_exports():
+            if export not in ('spk', 'uspk'):
+                tasks.append((export, shank, None, filenames, basename,
+                              blocksize))
+                continue
+            n_spikes = shapes[shank][0]
+            preallocate_spk(basename + '.' + export + '.' + str(shank),
+                            shapes[shank])
+            step = max(blocksize, -(-n_spikes // n_workers))
+            for start in xrange(0, n_spikes, step):
+                tasks.append((export, shank,
+                              (start, min(start + step, n_spikes)),
+                              filenames, basename, blocksize))
+    # the workers get the Parameters of this run, even if they are not forked
+    parameters = dict((k, v) for k, v in Parameters.iteritems()
+                      if not k.startswith('_'))
+    pool = Pool(n_workers, initializer=set_parameters, initargs=(parameters,))
+    try:
+        pool.map(export_klusters_file, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def set_parameters(parameters):
+    '''
+    Sets the Parameters of a worker process to those of the main process.
+    '''
+    Parameters.update(parameters)
+
+
+def export_klusters_file(task):
+    '''
+    Writes one Klusters file of a shank in a worker process, task being the
+    tuple (export, shank, rows, filenames, basename, blocksize) with rows as
+    for write_klusters_file and filenames the dictionary of the main and
+    waves HDF5 filenames.
+    '''
+    export, shank, rows, filenames, basename, blocksize = task
+    h5s = dict((key, openFile(filename, 'r'))
+               for key, filename in filenames.iteritems())
+    try:
+        shank_table = {}
+        for key, name in [('main', 'spikedetekt'), ('waves', 'waveforms')]:
+            node = h5s[key].getNode('/shanks/shank_' + str(shank), name)
+            shank_table[name, shank] = open_shank_table(node)
+        write_klusters_file(export, shank_table, shank, basename, blocksize,
+                            rows)
+    finally:
+        for h5 in h5s.values():
+            h5.close()
+
+
+def write_klusters_file(export, shank_table, shank, basename, blocksize=4096,
+                        rows=None):
+    '''
+    Writes the Klusters file export (one of KLUSTERS_EXPORTS) of a shank. For
+    the .spk and .uspk files, rows can be the pair (start, stop) of the spikes
+    to write into the file already preallocated, otherwise the file is
+    preallocated and all spikes are written.
+    '''
+    T = shank_table['spikedetekt', shank]
+    W = shank_table['waveforms', shank]
+    filepath = basename + '.' + export + '.' + str(shank)
+    if export in ('spk', 'uspk'):
+        if rows is None:
+            preallocate_spk(filepath, spk_shape(W))
+            rows = (0, len(W))
+        if export == 'spk':
+            write_spk_memmap(W, 'wave', filepath, rows[0], rows[1],
+                             blocksize, scale=wave_scale(W))
+        else:
+            write_spk_memmap(W, 'unfiltered_wave', filepath, rows[0], rows[1],
+                             blocksize)
+    elif export == 'fet':
+        write_fet_blocks(T, filepath, blocksize)
+    elif export == 'mask':
+        write_mask_blocks(T, 'mask_binary', filepath, "%i", blocksize)
+    elif export == 'fmask':
+        write_mask_blocks(T, 'mask_float', filepath, "%f", blocksize)
+    elif export == 'res':
         time = T.cols.time[:]
         write_trivial_clu(time, basename + '.clu.' + str(shank))
-        write_res(time, basename + '.res.' + str(shank))
-        write_spk_buffered(shank_table['waveforms', shank],
-                           'wave', basename + '.spk.' + str(shank),
-                           np.arange(len(time)))
-        write_spk_buffered(shank_table['waveforms', shank],
-                           'unfiltered_wave', basename + '.uspk.' + str(shank),
-                           np.arange(len(time)))
-        if Parameters['WRITE_XML_FILE']:
-            write_xml(probe,
-                      n_ch=Parameters['N_CH'],
-                      n_samp=Parameters['S_TOTAL'],
-                      n_feat=Parameters['FPC'],
-                      sample_rate=Parameters['SAMPLE_RATE'],
-                      filepath=basename + '.xml')
-        # compute feature masks from channel masks
-        M = np.repeat(T.cols.mask_binary[:], Parameters['FPC'], axis=1)
-        M = np.hstack((M, np.zeros(M.shape[0], dtype=M.dtype)[:, np.newaxis]))
-        write_mask(M, basename + '.mask.' + str(shank))
-        if Parameters['USE_FLOAT_MASKS']:
-            M = np.repeat(T.cols.mask_float[:], Parameters['FPC'], axis=1)
-            M = np.hstack(
-                (M, np.zeros(M.shape[0], dtype=M.dtype)[:, np.newaxis]))
-            write_mask(M, basename + '.fmask.' + str(shank), fmt='%f')
+        write_res(time, filepath)
+    else:
+        raise ValueError('Unknown Klusters file ' + export)
+
+
+def feature_mask(mask, fpc):
+    '''
+    Returns the feature mask, of shape (n_spikes, fpc*n_channels+1), of the
+    channel mask of shape (n_spikes, n_channels), the time being masked.
+    '''
+    M = np.repeat(mask, fpc, axis=1)
+    return np.hstack((M, np.zeros(M.shape[0], dtype=M.dtype)[:, np.newaxis]))
+
+
+def write_fet_blocks(T, filepath, blocksize=4096):
+    '''
+    Writes the .fet file of the spikedetekt table T, dense or sparse,
+    blocksize rows at a time so that the dense features of all spikes are
+    never held in memory.
+    '''
+    fet_file = open(filepath, 'w')
+    fet_file.write('%i\n' % T.dtype['features'].shape[0])
+    for start in xrange(0, len(T), blocksize):
+        features = T.cols.features[start:start + blocksize]
+        time = T.cols.time[start:start + len(features)]
+        write_text(fet_file, fet_values(features, time), fmt="%i")
+    fet_file.close()
+
+
+def fet_values(features, time):
+    '''
+    Returns the values of the .fet file of a block of spikes, the features
+    (with the time as last feature) as integers and the time as last column
+    from the int64 time column, which the float32 features only hold
+    exactly up to 2**24 samples.
+    '''
+    fet = np.empty(features.shape, dtype=np.int64)
+    fet[:, :-1] = np.array(features[:, :-1], dtype=np.int32)
+    fet[:, -1] = time
+    return fet
+
+
+def write_mask_blocks(T, column, filepath, fmt, blocksize=4096):
+    '''
+    Writes the .mask or .fmask file of the channel mask column of the
+    spikedetekt table T, dense or sparse, blocksize rows at a time.
+    '''
+    n_features = T.dtype['features'].shape[0]
+    # the features per channel of the table, not of the Parameters of this
+    # process, which may be a worker
+    fpc = (n_features - 1) // T.dtype[column].shape[0]
+    mask_file = open(filepath, 'w')
+    mask_file.write('%i\n' % n_features)
+    for start in xrange(0, len(T), blocksize):
+        mask = getattr(T.cols, column)[start:start + blocksize]
+        write_text(mask_file, feature_mask(mask, fpc), fmt=fmt)
+    mask_file.close()
+
+
+# the arrays of each shank in the NPY files, with their table and column
+NPY_ARRAYS = [('time', 'spikedetekt', 'time'),
+              ('features', 'spikedetekt', 'features'),
+              ('mask_binary', 'spikedetekt', 'mask_binary'),
+              ('mask_float', 'spikedetekt', 'mask_float'),
+              ('wave', 'waveforms', 'wave'),
+              ('unfiltered_wave', 'waveforms', 'unfiltered_wave')]
+
+
+def npy_files(main_h5, shank_table, basename, probe, blocksize=4096):
+    '''
+    Writes the spikes of each shank as .npy files in the directory
+    basename_npy, with a manifest.json file describing them, so that they can
+    be loaded with np.load(filename, mmap_mode='r'). The layout is::
+
+        basename_npy/manifest.json
+        basename_npy/shank_N/time.npy             (n_spikes,)
+        basename_npy/shank_N/features.npy         (n_spikes, n_ch, FPC)
+        basename_npy/shank_N/mask_binary.npy      (n_spikes, n_ch)
+        basename_npy/shank_N/mask_float.npy       (n_spikes, n_ch)
+        basename_npy/shank_N/wave.npy             (n_spikes, S_TOTAL, n_ch)
+        basename_npy/shank_N/unfiltered_wave.npy  (n_spikes, S_TOTAL, n_ch)
+        basename_npy/shank_N/PC_3s.npy            (FPC, S_TOTAL, n_ch)
+        basename_npy/shank_N/index.npy            (n_blocks,)
+
+    The features do not include the time, the last feature of the .fet
+    files. The arrays are filled blocksize spikes at a time from the tables
+    of shank_table, dense or sparse. index.npy holds the rows of the index
+    table of the shank (see SpikeIndex), whose manifest entry also has its
+    blocksize and amplitude_bins.
+    '''
+    directory = basename + '_npy'
+    manifest = {'format': 'spikedetekt-npy', 'version': 1,
+                'parameters': json_parameters(),
+                'probe': probe.probes,
+                'shanks': {}}
+    for shank in probe.shanks_set:
+        shank_dir = os.path.join(directory, 'shank_' + str(shank))
+        if not os.path.exists(shank_dir):
+            os.makedirs(shank_dir)
+        n_spikes = len(shank_table['spikedetekt', shank])
+        arrays = {}
+        for name, table, column in NPY_ARRAYS:
+            T = shank_table[table, shank]
+            dtype = T.dtype[column]
+            shape = (n_spikes,) + dtype.shape
+            if name == 'features':
+                # without the time, and with a channel axis
+                n_ch = (dtype.shape[0] - 1) // Parameters['FPC']
+                shape = (n_spikes, n_ch, Parameters['FPC'])
+            filename = os.path.join(shank_dir, name + '.npy')
+            arrays[name] = write_npy(filename, getattr(T.cols, column),
+                                     dtype.base, shape, blocksize)
+        group = main_h5.getNode('/shanks/shank_' + str(shank))
+        PC_3s = group.PC_3s[:]
+        np.save(os.path.join(shank_dir, 'PC_3s.npy'), PC_3s)
+        arrays['PC_3s'] = npy_entry(os.path.join(shank_dir, 'PC_3s.npy'),
+                                    PC_3s.dtype, PC_3s.shape)
+        manifest['shanks'][str(shank)] = {
+            'n_spikes': n_spikes,
+            'channels': sorted(int(c) for c in probe.channel_set[shank]),
+            'arrays': arrays}
+        if 'index' in group:
+            index = group.index.read()
+            filename = os.path.join(shank_dir, 'index.npy')
+            np.save(filename, index)
+            # the dtype of the rows is in the header of the .npy file
+            entry = npy_entry(filename, index.dtype, index.shape)
+            del entry['dtype']
+            entry['blocksize'] = int(group.index.attrs.blocksize)
+            entry['amplitude_bins'] = [
+                float(b) for b in group.index.attrs.amplitude_bins]
+            manifest['shanks'][str(shank)]['index'] = entry
+    with open(os.path.join(directory, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+
+def write_npy(filename, column, dtype, shape, blocksize=4096):
+    '''
+    Writes the .npy file filename of the given dtype and shape, from the
+    blocks of blocksize rows of column (a table column, sliced as
+    column[start:stop]) reshaped to shape, and returns its manifest entry.
+    '''
+    if not shape[0]:
+        np.save(filename, np.zeros(shape, dtype=dtype))
+        return npy_entry(filename, dtype, shape)
+    X = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype,
+                                  shape=shape)
+    for start in xrange(0, shape[0], blocksize):
+        block = column[start:start + blocksize]
+        if len(shape) == 3 and block.shape[1:] != shape[1:]:
+            # the features, without the time
+            block = block[:, :-1].reshape((len(block),) + shape[1:])
+        X[start:start + len(block)] = block
+    X.flush()
+    del X
+    return npy_entry(filename, dtype, shape)
+
+
+def npy_entry(filename, dtype, shape):
+    return {'file': os.path.join(os.path.basename(os.path.dirname(filename)),
+                                 os.path.basename(filename)),
+            'dtype': np.dtype(dtype).str, 'shape': list(shape)}
+
+
+def json_parameters():
+    '''
+    Returns the parameters as a dictionary that can be written as JSON, with
+    the repr of the values that cannot.
+    '''
+    parameters = {}
+    for k, v in Parameters.items():
+        if k.startswith('_'):
+            continue
+        try:
+            json.dumps(v)
+            parameters[k] = v
+        except (TypeError, ValueError):
+            parameters[k] = repr(v)
+    return parameters
+
+
+class KlustersStream(object):
+
+    '''
+    Writes the Klusters files of a shank while spikes are detected, instead
+    of storing them in the HDF5 files: the .res, .spk, .uspk, .mask and
+    .fmask files are appended to with each block of spikes, and the .fet and
+    .clu files written by finish once the principal components are known.
+    The features are computed from the .spk file, read back with a memory
+    map, so that the filtered waves are quantized as in that file.
+
+    Usage::
+
+        stream = KlustersStream(basename, shank, shanksize)
+        stream.append(sd_rows, wave_rows)
+        stream.close()
+        PC_3s = reget_features(stream.waves()[:n])
+        stream.finish(PC_3s)
+
+    with sd_rows and wave_rows record arrays with the columns of
+    shank_description(shanksize) and waveform_description(shanksize).
+    '''
+
+    def __init__(self, basename, shank, shanksize):
+        self.basename = basename
+        self.shank = shank
+        self.shanksize = shanksize
+        self.n_features = 1 + Parameters['FPC'] * shanksize
+        self.times = []
+        self.files = {}
+        for export in ['res', 'spk', 'uspk', 'mask', 'fmask']:
+            if export == 'fmask' and not Parameters['USE_FLOAT_MASKS']:
+                continue
+            mode = 'wb' if export in ('spk', 'uspk') else 'w'
+            self.files[export] = open(self.filepath(export), mode)
+        self.files['mask'].write('%i\n' % self.n_features)
+        if 'fmask' in self.files:
+            self.files['fmask'].write('%i\n' % self.n_features)
+
+    def filepath(self, export):
+        return self.basename + '.' + export + '.' + str(self.shank)
+
+    def append(self, sd_rows, wave_rows):
+        self.times.append(sd_rows['time'])
+        write_text(self.files['res'], sd_rows['time'], fmt="%i")
+        quantize_waves(wave_rows['wave']).tofile(self.files['spk'])
+        np.int16(wave_rows['unfiltered_wave']).tofile(self.files['uspk'])
+        write_text(self.files['mask'],
+                   feature_mask(sd_rows['mask_binary'], Parameters['FPC']),
+                   fmt="%i")
+        if 'fmask' in self.files:
+            write_text(self.files['fmask'],
+                       feature_mask(sd_rows['mask_float'],
+                                    Parameters['FPC']), fmt="%f")
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+
+    def waves(self):
+        '''
+        Returns the filtered waves of the closed .spk file, as a memory map of
+        shape (n_spikes, S_TOTAL, shanksize).
+        '''
+        shape = (-1, Parameters['S_TOTAL'], self.shanksize)
+        if not os.path.getsize(self.filepath('spk')):
+            return np.zeros((0,) + shape[1:], dtype=np.int16)
+        return np.memmap(self.filepath('spk'), dtype=np.int16,
+                         mode='r').reshape(shape)
+
+    def finish(self, PC_3s, blocksize=4096):
+        '''
+        Writes the .fet and .clu files, with the principal components PC_3s.
+        '''
+        time = np.hstack(self.times + [np.zeros(0, dtype=np.int64)])
+        write_trivial_clu(time, self.filepath('clu'))
+        waves = self.waves()
+        fet_file = open(self.filepath('fet'), 'w')
+        fet_file.write('%i\n' % self.n_features)
+        for start in xrange(0, len(waves), blocksize):
+            X = waves[start:start + blocksize]
+            # float32 as the features column of shank_description
+            features = np.empty((len(X), self.n_features), dtype=np.float32)
+            features[:, :-1] = project_features_block(PC_3s, X)
+            write_text(fet_file,
+                       fet_values(features, time[start:start + len(X)]),
+                       fmt="%i")
+        fet_file.close()
+
+
+# the columns of the spikes in the .live.h5 file, with the table they come from
+LIVE_COLUMNS = [('time', 'spikedetekt'), ('mask_binary', 'spikedetekt'),
+                ('mask_float', 'spikedetekt'), ('wave', 'waveforms')]
+
+
+class LiveWriter(object):
+
+    '''
+    Writes the spikes of each shank to the .live.h5 file while they are
+    detected, in HDF5 single writer multiple readers (SWMR) mode, so that
+    they can be read (with h5py, see reader.LiveSpikes) while detection runs.
+    PyTables does not support SWMR, so the file is written with h5py and
+    HDF5 1.10 or later.
+
+    The file has the datasets /shanks/shank_N/time, mask_binary, mask_float
+    and wave, which grow with the spikes, and /progress, the number of
+    samples searched for spikes so far, the number of samples and 1 once
+    detection is finished. flush writes the spikes first, then the progress,
+    so that all spikes before progress[0] can be read after refreshing
+    progress, then the spike datasets. Usage::
+
+        live = LiveWriter(basename + '.live.h5', probe, n_samples, row_dtype)
+        live.append(shank, sd_rows, wave_rows)
+        live.flush(keep_end)
+        live.close()
+    '''
+
+    def __init__(self, filename, probe, n_samples, row_dtype,
+                 chunk_bytes=256 * 1024):
+        self.h5 = h5py.File(filename, 'w', libver='latest')
+        self.h5.attrs['probe'] = json.dumps(probe.probes)
+        self.datasets = {}
+        for shank in probe.shanks_set:
+            group = self.h5.create_group('/shanks/shank_' + str(shank))
+            group.attrs['channels'] = sorted(probe.channel_set[shank])
+            for name, table in LIVE_COLUMNS:
+                dtype = row_dtype[table, shank][name]
+                chunkrows = max(1, chunk_bytes // dtype.itemsize)
+                self.datasets[shank, name] = group.create_dataset(
+                    name, shape=(0,) + dtype.shape, dtype=dtype.base,
+                    maxshape=(None,) + dtype.shape,
+                    chunks=(chunkrows,) + dtype.shape)
+        self.progress = self.h5.create_dataset(
+            'progress', data=np.array([0, n_samples, 0], dtype=np.int64))
+        # no objects can be created from now on
+        self.h5.swmr_mode = True
+
+    def append(self, shank, sd_rows, wave_rows):
+        rows = {'spikedetekt': sd_rows, 'waveforms': wave_rows}
+        for name, table in LIVE_COLUMNS:
+            dataset = self.datasets[shank, name]
+            n = len(dataset)
+            dataset.resize(n + len(sd_rows), axis=0)
+            dataset[n:] = rows[table][name]
+
+    def flush(self, samples_done, finished=False):
+        '''
+        Makes the spikes appended so far, and the progress samples_done,
+        visible to the readers.
+        '''
+        for dataset in self.datasets.values():
+            dataset.flush()
+        self.progress[0] = samples_done
+        self.progress[2] = int(finished)
+        self.progress.flush()
+
+    def close(self, samples_done):
+        self.flush(samples_done, finished=True)
+        self.h5.close()
 
 
 def write_mask(mask, filename, fmt="%i"):
     fd = open(filename, 'w')
     fd.write(str(mask.shape[1]) + '\n')  # number of features
-    np.savetxt(fd, mask, fmt=fmt)
+    write_text(fd, mask, fmt=fmt)
     fd.close()
 
 
@@ -285,6 +1278,123 @@ def num_samples(FileNames, n_ch_dat, n_bytes=2):
     return total_bytes // (n_ch_dat * n_bytes)
 
 
+# the characters of the 4 digits of each integer from 0 to 9999 (as uint32
+# for fast indexing), and the powers of 10 that fit in a uint64, for
+# decimal_chars
+DIGITS_4 = np.array([list('%04i' % i)
+                     for i in xrange(10000)]).view(np.uint32).ravel()
+POWERS_10 = np.uint64(10) ** np.arange(1, 20, dtype=np.uint64)
+# bound on the absolute values formatted by format_floats, whose number of
+# millionths must fit in a uint64 (below 1.8e19)
+MAX_FORMAT_FLOAT = 1e13
+
+
+def decimal_chars(u, neg, extra=0):
+    """input: u 1D uint64 array of nonnegative integers, neg boolean array
+    of the same shape
+    output: (chars, keep), chars a uint8 array of shape (n, 1+n_digits+extra)
+    with a minus sign followed by the digits of u right aligned and extra
+    columns left for the caller, and keep the boolean array of the characters
+    of the decimal representation, the minus sign where neg, and the extra
+    columns"""
+    n_chunks = max(1, (len(str(int(u.max()))) + 3) // 4) if len(u) else 1
+    width = 1 + 4 * n_chunks
+    chars = np.empty((len(u), width + extra), dtype=np.uint8)
+    chars[:, 0] = ord('-')
+    # 4 digits at a time, from the right
+    q = u
+    for k in xrange(n_chunks - 1, -1, -1):
+        r = (q % np.uint64(10000)).astype(np.intp)
+        q = q // np.uint64(10000)
+        chars[:, 1 + 4 * k:5 + 4 * k] = \
+            DIGITS_4.take(r).view(np.uint8).reshape(-1, 4)
+    # column j has the digit of 10**(width-1-j), a leading zero if u is
+    # smaller, the last digit is always kept
+    keep = np.ones(chars.shape, dtype=bool)
+    keep[:, 0] = neg
+    for j in xrange(1, width - 1):
+        keep[:, j] = u >= POWERS_10[width - 2 - j]
+    return chars, keep
+
+
+def format_ints(X, extra=0):
+    """input: integer array X
+    output: (chars, keep) as for decimal_chars, for "%i" % x of each value x
+    of X in row major order"""
+    X = X.ravel()
+    if X.dtype == np.uint64:
+        return decimal_chars(X, np.zeros(len(X), dtype=bool), extra)
+    X = X.astype(np.int64)
+    # the absolute value of the most negative int64 is right once unsigned
+    return decimal_chars(np.abs(X).astype(np.uint64), X < 0, extra)
+
+
+def format_floats(X, extra=0):
+    """input: float array X of finite values below MAX_FORMAT_FLOAT in
+    absolute value
+    output: (chars, keep) as for decimal_chars, for "%f" % x of each value x
+    of X in row major order"""
+    X = X.ravel().astype(np.float64)
+    a = np.abs(X)
+    # the value rounded to 6 decimals, as an integer number of millionths,
+    # formatted one by one where the rounding error of a*1e6 (relative, below
+    # 1.2e-16) could change the rounding, or where it is too large
+    y = a * 1e6
+    r = np.floor(y + .5)
+    check = (np.abs(y - np.floor(y) - .5) <= 1e-15 * y) | (a >= 1e9)
+    r = r.astype(np.uint64)
+    for i in check.nonzero()[0]:
+        r[i] = int(('%f' % a[i]).replace('.', ''))
+    units = np.uint64(1000000)
+    chars, keep = decimal_chars(r // units, np.signbit(X), 7 + extra)
+    fraction = (r % units).astype(np.intp)
+    width = chars.shape[1] - 7 - extra
+    chars[:, width] = ord('.')
+    chars[:, width + 1:width + 3] = DIGITS_4.take(
+        fraction // 10000).view(np.uint8).reshape(-1, 4)[:, 2:]
+    chars[:, width + 3:width + 7] = DIGITS_4.take(
+        fraction % 10000).view(np.uint8).reshape(-1, 4)
+    return chars, keep
+
+
+def write_text(f, X, fmt="%i", blocksize=65536):
+    """writes the 1D or 2D array X to the file or filename f, byte for byte
+    as np.savetxt(f, X, fmt=fmt), one row per line separated by spaces, but
+    formatting blocks of about blocksize values at once. Integer arrays with
+    fmt "%i" and float arrays with fmt "%f" are formatted with numpy
+    operations, other arrays (and blocks of floats with non-finite values or
+    values too large for format_floats) with one string formatting per
+    block"""
+    if isinstance(f, basestring):
+        with open(f, 'w') as fd:
+            return write_text(fd, X, fmt, blocksize)
+    X = np.asarray(X)
+    if X.ndim == 1:
+        X = X[:, np.newaxis]
+    n_cols = X.shape[1]
+    rows = max(1, blocksize // max(n_cols, 1))
+    if fmt in ('%i', '%d') and X.dtype.kind in 'iu':
+        formatter = format_ints
+    elif fmt == '%f' and X.dtype.kind == 'f':
+        formatter = format_floats
+    else:
+        formatter = None
+    line = ' '.join([fmt] * n_cols) + '\n'
+    for start in xrange(0, len(X), rows):
+        block = X[start:start + rows]
+        if (formatter is None or not block.size or
+                (formatter is format_floats and
+                 not (np.isfinite(block).all() and
+                      np.abs(block).max() < MAX_FORMAT_FLOAT))):
+            f.write((line * len(block)) % tuple(block.ravel().tolist()))
+            continue
+        # each value is followed by a space, or a newline at the end of a row
+        chars, keep = formatter(block, extra=1)
+        chars[:, -1] = ord(' ')
+        chars[n_cols - 1::n_cols, -1] = ord('\n')
+        f.write(chars[keep].tostring())
+
+
 def write_clu(clus, filepath):
     """writes cluster cluster assignments to text file readable by klusters and neuroscope.
     input: clus is a 1D or 2D numpy array of integers
@@ -296,7 +1406,7 @@ def write_clu(clus, filepath):
     n_clu = clus.max() + 1
     clu_file.write('%i\n' % n_clu)
     # one cluster per line
-    np.savetxt(clu_file, np.int16(clus), fmt="%i")
+    write_text(clu_file, np.int16(clus), fmt="%i")
     clu_file.close()
 
 
@@ -312,7 +1422,7 @@ def write_trivial_clu(restimes, filepath):
     n_clu = clus.max() + 1
     clu_file.write('%i\n' % n_clu)
     # one cluster per line
-    np.savetxt(clu_file, np.int16(clus), fmt="%i")
+    write_text(clu_file, np.int16(clus), fmt="%i")
     clu_file.close()
 
 
@@ -323,11 +1433,11 @@ def read_clu(filepath):
 
 def write_fet(feats, filepath):
     feat_file = open(filepath, 'w')
-    feats = np.array(feats, dtype=np.int32)
+    feats = np.array(feats, dtype=np.int64)
     # header line: number of features
     feat_file.write('%i\n' % feats.shape[1])
     # next lines: one feature vector per line
-    np.savetxt(feat_file, feats, fmt="%i")
+    write_text(feat_file, feats, fmt="%i")
     feat_file.close()
 
 
@@ -335,18 +1445,26 @@ def read_fet(filepath):
     """reads feature file and returns it as an array. note that the last
     column might contain the times"""
     # skip first line and read the rest
-    return np.loadtxt(filepath, dtype=np.int32, skiprows=1).astype(np.float32)
+    return np.loadtxt(filepath, dtype=np.int64, skiprows=1).astype(np.float32)
 
 
 def write_res(samples, filepath):
     """input: 1D vector of times shape = (n_times,) or (n_times, 1)
     output: writes .res file, which has integer sample numbers"""
-    np.savetxt(filepath, samples, fmt="%i")
+    write_text(filepath, samples, fmt="%i")
+
+
+def write_artifacts(intervals, filepath):
+    """input: list of pairs (start, end) of sample intervals rejected as
+    artifacts, end excluded
+    output: writes .artifacts file, one interval per line"""
+    write_text(filepath, np.array(intervals, dtype=np.int64).reshape(-1, 2),
+               fmt="%i")
 
 
 def read_res(filepath):
     """reads .res file, which is just a list of integer sample numbers"""
-    return np.loadtxt(filepath, dtype=np.int32)
+    return np.loadtxt(filepath, dtype=np.int64)
 
 
 def write_spk(waves, filepath, nonzero=None):
@@ -361,15 +1479,57 @@ def write_spk(waves, filepath, nonzero=None):
     waves.tofile(filepath)
 
 
+def spk_values(waves, scale=(1., 0.)):
+    """returns the waves as the int16 values written to .spk files, where
+    scale is the pair (scale, offset) of the stored values, int16 waves with
+    scale (1, 0) are returned as they are"""
+    if waves.dtype != np.int16 or scale != (1., 0.):
+        waves = np.int16(waves * scale[0] + scale[1])
+    return waves
+
+
 def write_spk_buffered(table, column, filepath, indices,
-                       channels=slice(None), buffersize=512):
+                       channels=slice(None), buffersize=512, scale=(1., 0.)):
+    """writes the waves of column for the rows indices of table to a .spk
+    file, where scale is the pair (scale, offset) of the stored values"""
     with open(filepath, 'wb') as f:
         numitems = len(indices)
         for i in xrange(0, numitems, buffersize):
             waves = table[indices[i:i + buffersize]][column]
             waves = waves[:, :, channels]
-            waves = np.int16(waves)
-            waves.tofile(f)
+            spk_values(waves, scale).tofile(f)
+
+
+def spk_shape(table):
+    """returns the shape (n_spikes, n_samples, n_channels) of the .spk file
+    of a waveforms table"""
+    return (len(table),) + table.dtype['wave'].shape
+
+
+def preallocate_spk(filepath, shape):
+    """creates the .spk file filepath for int16 waves of the given shape,
+    filled with zeros"""
+    with open(filepath, 'wb') as f:
+        f.truncate(2 * int(np.prod(shape)))
+
+
+def write_spk_memmap(table, column, filepath, start=0, stop=None,
+                     blocksize=4096, scale=(1., 0.)):
+    """writes the waves of column for the rows start:stop of table to the
+    preallocated .spk file filepath, through a memory map, in contiguous
+    slices of blocksize rows, where scale is as for spk_values. Ranges of
+    rows of the same file can be written concurrently"""
+    if stop is None:
+        stop = len(table)
+    if start >= stop:
+        return
+    shape = (len(table),) + table.dtype[column].shape
+    spk = np.memmap(filepath, dtype=np.int16, mode='r+', shape=shape)
+    for i in xrange(start, stop, blocksize):
+        waves = getattr(table.cols, column)[i:min(i + blocksize, stop)]
+        spk[i:i + len(waves)] = spk_values(waves, scale)
+    spk.flush()
+    del spk
 
 
 def read_spk(filepath, n_ch, n_s):
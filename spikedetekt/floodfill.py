@@ -92,3 +92,57 @@ def connected_components(st_arr, ch_graph, s_back):
             c_label += 1
     # only return the values, because we don't actually need the labels
     return comp_inds.values()
+
+
+def split_component(IndList, max_samples):
+    '''
+    Splits a connected component (a list of pairs (samp, chan)) which spans
+    more than max_samples samples at the local minima of its crossing
+    profile, the number of channels crossing at each sample, smoothed with
+    the kernel [1, 2, 1]. A cut is only made at a true interior minimum p[i]
+    with p[i] < p[i-1] and p[i] <= p[i+1], the deepest one, nearest the
+    middle in case of ties, and is repeated on each piece until it fits. A
+    piece without such a minimum (a single spike) is left whole, even if it
+    is still longer than max_samples. Returns the list of pieces in time
+    order, [IndList] if it was not split.
+
+    >>> profile = [1, 2, 3, 3, 3, 3, 3, 2, 1]
+    >>> IndList = [(100 + s, c) for s, n in enumerate(profile)
+    ...            for c in range(n)]
+    >>> split_component(IndList, 6) == [IndList]
+    True
+    >>> profile = [1, 3, 3, 1, 1, 3, 3, 1]
+    >>> IndList = [(100 + s, c) for s, n in enumerate(profile)
+    ...            for c in range(n)]
+    >>> [sorted(set(s for s, c in piece))
+    ...  for piece in split_component(IndList, 6)]
+    [[100, 101, 102], [103, 104, 105, 106, 107]]
+    '''
+    IndArr = np.array(IndList, dtype=int32)
+    pieces = []
+    stack = [IndArr]
+    while stack:
+        Arr = stack.pop()
+        samps = Arr[:, 0]
+        s_min = samps.min()
+        width = samps.max() - s_min + 1
+        if width <= max_samples or width < 3:
+            pieces.append(Arr)
+            continue
+        p = np.bincount(samps - s_min)
+        p = np.hstack((p[0], p, p[-1]))
+        p = p[:-2] + 2 * p[1:-1] + p[2:]
+        interior = p[1:-1]
+        is_min = (interior < p[:-2]) & (interior <= p[2:])
+        minima, = is_min.nonzero()
+        if not len(minima):
+            pieces.append(Arr)
+            continue
+        deepest = minima[interior[minima] == interior[minima].min()]
+        cut = s_min + 1 + deepest[np.argmin(np.abs(deepest + 1 - width / 2.))]
+        # the later piece is pushed first so that pieces come out in order
+        stack.append(Arr[samps >= cut])
+        stack.append(Arr[samps < cut])
+    if len(pieces) == 1:
+        return [IndList]
+    return [[tuple(p) for p in piece] for piece in pieces]
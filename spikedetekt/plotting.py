@@ -4,6 +4,7 @@ Various tools for plotting
 
 from pylab import *
 import tables
+from files import open_shank_table
 
 
 class AttributeToItem(object):
@@ -70,17 +71,36 @@ class SpikeTable(object):
         fet_mask        (numfeatures)
 
     These are defined in spike_dtype() in files.py
+
+    For the .main.h5 files with one group per shank, give the shank number::
+
+        st = SpikeTable(filename, shank=1)
+
+    The spikes are then those of /shanks/shank_N/spikedetekt (defined in
+    shank_description() in files.py), and the principal components of the
+    shank, stored once for all spikes, are available as::
+
+        st.PC_3s        (features_per_channel, samples_per_spike, numchannels)
     '''
 
-    def __init__(self, filename):
+    def __init__(self, filename, shank=None):
         self.filename = filename
         self.hdf5file = tables.openFile(filename)
-        self.spiketable = self.hdf5file.root.SpikeTable_temp
+        if shank is None:
+            self.spiketable = self.hdf5file.root.SpikeTable_temp
+            self.numspikes = len(self.spiketable)
+            self.numchannels = self.spiketable[0]['wave'].shape[1]
+            self.features_per_channel = self.spiketable[0]['fet'].shape[1]
+            self.numfeatures = self.spiketable[0]['fet_mask'].shape[0]
+            self.samples_per_spike = self.spiketable[0]['wave'].shape[0]
+            return
+        shank_group = self.hdf5file.getNode('/shanks/shank_' + str(shank))
+        self.spiketable = open_shank_table(shank_group.spikedetekt)
+        self.PC_3s = shank_group.PC_3s[:]
         self.numspikes = len(self.spiketable)
-        self.numchannels = self.spiketable[0]['wave'].shape[1]
-        self.features_per_channel = self.spiketable[0]['fet'].shape[1]
-        self.numfeatures = self.spiketable[0]['fet_mask'].shape[0]
-        self.samples_per_spike = self.spiketable[0]['wave'].shape[0]
+        (self.features_per_channel, self.samples_per_spike,
+         self.numchannels) = self.PC_3s.shape
+        self.numfeatures = self.spiketable.dtype['features'].shape[0]
 
     def __getitem__(self, i):
         return AttributeToItem(self.spiketable[i])
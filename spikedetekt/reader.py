@@ -0,0 +1,327 @@
+'''
+Lazy reading of the spikes of a shank from the output of SpikeDetekt, the
+.main.h5 file (with the .waves.h5 file it links to) or the NPY directory
+written with WRITE_NPY_FILES. Usage::
+
+    spikes = open_spikes('myexperiment.main.h5', shank=1)
+    len(spikes)
+    spikes.columns
+    spikes.read(['time', 'mask_float'], start, stop)
+    spikes.read_times(start_time, end_time, ['time', 'features'])
+    for block in spikes.iterchunks(['features'], chunksize=10000):
+        block['features']
+    spikes.close()
+
+Only the columns asked for are read, and only for the spikes asked for.
+Blocks are dictionaries of numpy arrays with the columns:
+
+time
+    The sample of each spike, shape (n_spikes,).
+features
+    The features, without the time, shape (n_spikes, n_channels, FPC).
+mask_binary, mask_float
+    The channel masks, shape (n_spikes, n_channels).
+wave, unfiltered_wave
+    The waves, shape (n_spikes, S_TOTAL, n_channels).
+
+or, for the output of DETECT_ONLY, time, peak_channel, peak_amplitude and
+n_channels. Times are sorted, so that the spikes of a time range are found
+by binary search, within the blocks of the index of the shank (see
+files.SpikeIndex) when there is one. The index also gives the number of
+spikes per channel and the histogram of their peak amplitudes, by blocks::
+
+    spikes.summary(start_time, end_time)
+
+The .live.h5 file written with LIVE_HDF5 is read while detection runs with
+a LiveSpikes reader, whose refresh method makes the new spikes visible::
+
+    spikes = open_spikes('myexperiment.live.h5', shank=1)
+    while not spikes.finished:
+        n = len(spikes)
+        spikes.refresh()
+        spikes.read(['time', 'wave'], n)
+        time.sleep(1)
+'''
+import os
+import json
+import numpy as np
+import tables
+import h5py
+from files import open_shank_table
+
+__all__ = ['open_spikes', 'HDF5Spikes', 'NPYSpikes', 'LiveSpikes']
+
+
+def open_spikes(path, shank):
+    '''
+    Returns the reader of the spikes of a shank, from a .main.h5 file, a
+    .live.h5 file or an NPY directory (with a manifest.json file).
+    '''
+    if os.path.isdir(path):
+        return NPYSpikes(path, shank)
+    if path.endswith('.live.h5'):
+        return LiveSpikes(path, shank)
+    return HDF5Spikes(path, shank)
+
+
+class Spikes(object):
+
+    '''
+    Base class of the readers, which define columns, __len__ and
+    column(name), returning an object that can be sliced as
+    column[start:stop] and indexed as column[i], and index, the rows of
+    their SpikeIndex table (or None).
+    '''
+
+    index = None
+
+    def read(self, columns=None, start=0, stop=None):
+        '''
+        Returns the dictionary of the arrays of the columns (all of them if
+        None) for the spikes start:stop.
+        '''
+        if columns is None:
+            columns = self.columns
+        if stop is None:
+            stop = len(self)
+        return dict((name, self.column(name)[start:stop])
+                    for name in columns)
+
+    def search_time(self, time, side='left'):
+        '''
+        Returns the index of the first spike at time or after (after time
+        with side 'right'), by binary search on the sorted times.
+        '''
+        column = self.column('time')
+        lo, hi = 0, len(self)
+        if self.index is not None and len(self.index):
+            # the spike is after the blocks whose times are all before time,
+            # and before the blocks whose times are all after
+            i = np.searchsorted(self.index['last_time'], time, side=side)
+            if i < len(self.index):
+                lo = int(self.index['start'][i])
+            else:
+                lo = hi
+            i = np.searchsorted(self.index['first_time'], time, side=side)
+            if i < len(self.index):
+                hi = int(self.index['start'][i])
+        while lo < hi:
+            mid = (lo + hi) // 2
+            t = column[mid]
+            if t < time or (side == 'right' and t == time):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def time_range(self, start_time, end_time):
+        '''
+        Returns the pair (start, stop) of the spikes with start_time <= time <
+        end_time.
+        '''
+        return self.search_time(start_time), self.search_time(end_time)
+
+    def summary(self, start_time=None, end_time=None):
+        '''
+        Returns a dictionary with the number of spikes n_spikes, the number
+        of spikes per channel channel_count, and the histogram of the peak
+        amplitudes amplitude_count over the bins amplitude_bins, of the
+        blocks of the index with spikes in start_time <= time < end_time
+        (all blocks if None), and the rows start:stop of these blocks.
+        '''
+        index = self.index
+        if index is None:
+            raise ValueError('No index for these spikes')
+        keep = np.ones(len(index), dtype=bool)
+        if start_time is not None:
+            keep &= index['last_time'] >= start_time
+        if end_time is not None:
+            keep &= index['first_time'] < end_time
+        index = index[keep]
+        return dict(
+            n_spikes=int((index['stop'] - index['start']).sum()),
+            channel_count=index['channel_count'].sum(axis=0),
+            amplitude_count=index['amplitude_count'].sum(axis=0),
+            amplitude_bins=self.amplitude_bins,
+            start=int(index['start'][0]) if len(index) else 0,
+            stop=int(index['stop'][-1]) if len(index) else 0)
+
+    def read_times(self, start_time, end_time, columns=None):
+        '''
+        Returns the columns, as read, for the spikes with start_time <= time <
+        end_time.
+        '''
+        start, stop = self.time_range(start_time, end_time)
+        return self.read(columns, start, stop)
+
+    def iterchunks(self, columns=None, chunksize=65536, start=0, stop=None):
+        '''
+        Yields the columns, as read, for blocks of chunksize spikes from
+        start to stop.
+        '''
+        if stop is None:
+            stop = len(self)
+        for i in xrange(start, stop, chunksize):
+            yield self.read(columns, i, min(i + chunksize, stop))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class FeatureColumn(object):
+
+    '''
+    The features column of a table, (n_spikes, n_channels*FPC+1) with the
+    time as last feature, as (n_spikes, n_channels, FPC).
+    '''
+
+    def __init__(self, column, fpc):
+        self.column = column
+        self.fpc = fpc
+
+    def __getitem__(self, key):
+        F = self.column[key]
+        return F[..., :-1].reshape(F.shape[:-1] + (-1, self.fpc))
+
+
+class HDF5Spikes(Spikes):
+
+    '''
+    Reader of the spikes of a shank in a .main.h5 file, from its spikedetekt
+    and waveforms tables (dense or sparse), or its detections table.
+    '''
+
+    def __init__(self, filename, shank):
+        self.h5 = tables.openFile(filename, 'r')
+        group = self.h5.getNode('/shanks/shank_' + str(shank))
+        self.fpc = None
+        self.tables = {}
+        if 'spikedetekt' in group:
+            self.tables['spikedetekt'] = open_shank_table(group.spikedetekt)
+            features = self.tables['spikedetekt'].dtype['features']
+            n_channels = self.tables['spikedetekt'].dtype['mask_binary'].shape[0]
+            self.fpc = (features.shape[0] - 1) // n_channels
+            if 'waveforms' in group:
+                node = group.waveforms
+                if isinstance(node, tables.link.ExternalLink):
+                    # opens the .waves.h5 file, read-only
+                    node = node()
+                self.tables['waveforms'] = open_shank_table(node)
+        elif 'detections' in group:
+            self.tables['detections'] = group.detections
+        else:
+            self.h5.close()
+            raise ValueError('No spikes for shank %s in %s, written with '
+                             'STREAM_KLUSTERS?' % (shank, filename))
+        if 'index' in group:
+            # small enough to be read once
+            self.index = group.index.read()
+            self.amplitude_bins = group.index.attrs.amplitude_bins
+        self.table_of = {}
+        for key in ['spikedetekt', 'waveforms', 'detections']:
+            if key in self.tables:
+                for name in self.tables[key].dtype.names:
+                    if name != 'channel_mask':
+                        self.table_of[name] = self.tables[key]
+        self.columns = sorted(self.table_of)
+
+    def __len__(self):
+        return len(self.table_of['time'])
+
+    def column(self, name):
+        column = getattr(self.table_of[name].cols, name)
+        if name == 'features':
+            return FeatureColumn(column, self.fpc)
+        return column
+
+    def close(self):
+        if 'waveforms' in self.tables:
+            self.tables['waveforms'].attrs._v_node._v_file.close()
+        self.h5.close()
+
+
+class NPYSpikes(Spikes):
+
+    '''
+    Reader of the spikes of a shank in an NPY directory, whose arrays are
+    memory mapped, with the index of the shank if it has one.
+    '''
+
+    def __init__(self, directory, shank):
+        with open(os.path.join(directory, 'manifest.json')) as f:
+            self.manifest = json.load(f)
+        entry = self.manifest['shanks'][str(shank)]
+        arrays = entry['arrays']
+        self.arrays = dict((name, np.load(os.path.join(directory,
+                                                       entry['file']),
+                                          mmap_mode='r'))
+                           for name, entry in arrays.iteritems()
+                           if name != 'PC_3s')
+        self.columns = sorted(self.arrays)
+        self.n_spikes = entry['n_spikes']
+        if 'index' in entry:
+            self.index = np.load(os.path.join(directory,
+                                              entry['index']['file']))
+            self.amplitude_bins = np.array(entry['index']['amplitude_bins'])
+
+    def __len__(self):
+        return self.n_spikes
+
+    def column(self, name):
+        return self.arrays[name]
+
+    def search_time(self, time, side='left'):
+        # the memory map is only read where the binary search looks
+        return int(np.searchsorted(self.arrays['time'], time, side=side))
+
+    def close(self):
+        self.arrays = {}
+
+
+class LiveSpikes(Spikes):
+
+    '''
+    Reader of the spikes of a shank in a .live.h5 file, in HDF5 single writer
+    multiple readers (SWMR) mode, with the columns time, mask_binary,
+    mask_float and wave (see files.LiveWriter). The spikes written by the
+    detection after the reader was opened are read after calling refresh.
+    '''
+
+    def __init__(self, filename, shank):
+        self.h5 = h5py.File(filename, 'r', libver='latest', swmr=True)
+        self.group = self.h5['/shanks/shank_' + str(shank)]
+        self.columns = sorted(self.group)
+        self.refresh()
+
+    def refresh(self):
+        '''
+        Makes the spikes written so far visible, and updates samples_done,
+        the number of samples searched for spikes, n_samples and finished.
+        '''
+        # the progress first, the spikes before progress[0] are then all
+        # in the spike datasets
+        progress = self.h5['progress']
+        progress.refresh()
+        self.samples_done, self.n_samples, finished = progress[:]
+        self.finished = bool(finished)
+        for name in self.columns:
+            self.group[name].refresh()
+        # the spikes in all the columns, flushed one after the other
+        self.n_spikes = min(len(self.group[name]) for name in self.columns)
+
+    def __len__(self):
+        return self.n_spikes
+
+    def column(self, name):
+        return self.group[name]
+
+    def read(self, columns=None, start=0, stop=None):
+        if stop is None:
+            stop = len(self)
+        return Spikes.read(self, columns, start, min(stop, len(self)))
+
+    def close(self):
+        self.h5.close()